@@ -6,9 +6,14 @@ import numpy as np
 from scipy import optimize
 from plant import Plant
 import utils
+from cache import EnergyCache
 
+## repeated evaluations of the same layout are cached
+cache = EnergyCache()
+
+@cache
 def f(x):
-    plant.layout = x.reshape((5, 2))
+    plant.layout = x.reshape((-1, 2))
     plant.set_layout()
     return -utils.get_energy(plant)
 
@@ -52,4 +57,5 @@ if __name__ == "__main__":
     print(plant.valid_layout)
     print(utils.get_energy(plant))
 
+    print(cache)
     utils.save_layout(x[:, 0], x[:, 1], "annealing-layout")
@@ -6,6 +6,7 @@ import numpy as np
 from scipy import optimize
 from plant import Plant
 import utils
+from cache import EnergyCache
 
 class RandomDisplacementBounds(object):
     """Custom step-function using random displacement with bounds.
@@ -26,10 +27,22 @@ class RandomDisplacementBounds(object):
 
         return xnew
 
+## repeated evaluations of the same layout are cached
+cache = EnergyCache()
+
+@cache
 def f(x):
-    plant.layout = x.reshape((5, 2))
+    plant.layout = x.reshape((-1, 2))
+    plant.set_layout()
+    return -utils.get_energy(plant, engine="interval")
+
+@cache
+def jac(x):
+    ''' Gradient of f by central differences, each partial derivative moves
+    one heliostat, see utils.get_gradient. '''
+    plant.layout = x.reshape((-1, 2))
     plant.set_layout()
-    return -utils.get_energy(plant)
+    return -utils.get_gradient(plant).flatten()
 
 if __name__ == "__main__":
     ## Tiny plant, n=5 heliostats
@@ -50,7 +63,7 @@ if __name__ == "__main__":
     ## optimize
     bounded_step = RandomDisplacementBounds(
         np.array([b[0] for b in bounds]), np.array([b[1] for b in bounds]))
-    minimizer_kwargs = {"bounds": bounds}
+    minimizer_kwargs = {"bounds": bounds, "jac": jac}
     result = optimize.basinhopping(f,
                                    x0,
                                    minimizer_kwargs=minimizer_kwargs,
@@ -91,4 +104,5 @@ if __name__ == "__main__":
     print(plant.valid_layout)
     print(utils.get_energy(plant))
 
+    print(cache)
     utils.save_layout(x[:, 0], x[:, 1], "basinhopping-layout")
@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" batch.py - evaluates the plant for all sun angles at once.
+
+    Instead of building a State for every sun angle, the geometry of all
+    heliostats, rays and sun angles is built as (m, n, heli_rays, 2) arrays
+    and reduced to the power in each sun angle. The results are the same as
+    with utils.get_power(plant, State(plant, sun_angle)) for each angle.
+"""
+
+import copy
+import numpy as np
+import geometry
+import profiling
+import records
+from state import State
+
+## rays of the layouts evaluated together as a Population in get_energies,
+## larger groups are not faster as their arrays do not fit in the cache,
+## see bench-population.py
+POPULATION_RAYS = 2**15
+
+class Population:
+    ''' Layouts of S plants that differ only in the layout, for evaluating
+    them together. The layout dependent attributes of Plant are stacked in
+    arrays of shape (S, 1, ...), where the second axis broadcasts against
+    the sun angles, so they can be used in place of a plant in get_masks.
+    '''
+    def __init__(self, plant, layouts):
+        self.heli_size = plant.heli_size
+        self.heli_rays = plant.heli_rays
+        self.ray_dtype = plant.ray_dtype
+        self.rec_a, self.rec_b = plant.rec_a, plant.rec_b
+
+        ## set_layout of a copy of the plant for each layout
+        self.plants = []
+        for layout in layouts:
+            scratch = copy.copy(plant)
+            scratch.layout = np.array(layout)
+            scratch.set_layout()
+            self.plants.append(scratch)
+        self.valid_layout = np.array([scratch.valid_layout for scratch in self.plants])
+        for name in ["layout", "heli_refs", "ref_lengths", "heli_aas", "max_ij"]:
+            values = [getattr(scratch, name) for scratch in self.plants]
+            setattr(self, name, np.array(values)[:, None])
+        self.max_ij = self.max_ij[..., None]
+        self.n = self.layout.shape[-2]
+
+    def get_windows(self, d_factor):
+        ''' Returns the windows of Plant.get_windows of all the layouts, with
+        the heliostat i of layout s numbered s * n + i. The windows of small
+        layouts are found at once, with all the pairs as the candidates. '''
+        S, n = len(self.plants), self.n
+        if S * n * n > geometry.MAX_PAIRS:
+            shading, blocking = [], []
+            for s, scratch in enumerate(self.plants):
+                (pairs_i, pairs_k, centers, half_widths), (block_i, block_k) = \
+                    scratch.get_windows(d_factor)
+                shading.append((pairs_i + s * n, pairs_k + s * n, centers, half_widths))
+                blocking.append((block_i + s * n, block_k + s * n))
+            return tuple(map(np.concatenate, zip(*shading))), \
+                tuple(map(np.concatenate, zip(*blocking)))
+
+        layout = self.layout.reshape((-1, 2))
+        pairs_i, pairs_k = np.nonzero(~np.eye(n, dtype=bool))
+        offsets = n * np.arange(S)[:, None]
+        pairs_i, pairs_k = (pairs_i + offsets).ravel(), (pairs_k + offsets).ravel()
+
+        ## as Plant.get_windows, the candidates of shading are the pairs
+        ## closer than the sun rays plus the reach
+        dists = np.sqrt(np.sum((layout[pairs_k] - layout[pairs_i])**2, axis=-1))
+        lengths = self.max_ij.ravel() * d_factor + geometry.get_reach(self.heli_size)
+        close = dists < np.repeat(lengths, n * (n - 1))
+        shading = (pairs_i[close], pairs_k[close]) + geometry.get_shading_windows(
+            layout, self.heli_size, pairs_i[close], pairs_k[close])
+        blocking = geometry.get_blocking_pairs(layout, self.heli_size,
+            (self.heli_refs - self.layout).reshape((-1, 2)),
+            self.ref_lengths.ravel() * d_factor, (pairs_i, pairs_k))
+        return shading, blocking
+
+def get_angles_chunk(plant):
+    ''' Returns the number of sun angles that are evaluated together, so
+    that the ray points arrays stay below geometry.MAX_PAIRS elements. '''
+    return max(1, geometry.MAX_PAIRS // max(1, plant.n * plant.heli_rays))
+
+def get_geometry(plant, sun_angles, heliostats=slice(None)):
+    ''' Returns the sun vectors, normals and edge points of the heliostats of
+    shape (m, n, 2) and the surface points, reflected rays ends and sun rays
+    ends of shape (m, n, heli_rays, 2), for the given heliostats only. '''
+    layout = plant.layout[..., heliostats, :]
+    heli_refs = plant.heli_refs[..., heliostats, :]
+    heli_suns, heli_normals, heli_tans, heli_as, heli_bs = \
+        geometry.get_mirrors(layout, heli_refs, sun_angles, plant.heli_size)
+
+    ## ray points, stored in plant.ray_dtype as in State
+    surf_points, ref_ends, sun_ends = [
+        points.astype(plant.ray_dtype) for points in geometry.get_ray_points(
+            heli_bs, heli_tans, plant.heli_size, plant.heli_rays,
+            heli_refs - layout, plant.ref_lengths[..., heliostats],
+            heli_suns - layout, np.expand_dims(plant.max_ij, -1), State.d_factor)]
+
+    return heli_suns, heli_normals, heli_as, heli_bs, \
+        surf_points, ref_ends, sun_ends
+
+def get_hit_rays_pairs(heli_as, heli_bs, starts, ends, ts, pairs_i, pairs_k):
+    ''' Returns which rays of shape (..., m, n, heli_rays) hit any
+    heliostat, as geometry.get_hit_rays, testing only the rays of heliostat
+    pairs_i[p] against heliostat pairs_k[p] in sun angle ts[p]. With a
+    leading dimension for S layouts, heliostat i of layout s is numbered
+    s * n + i, as in Population.get_windows. '''
+    m, n, rays = starts.shape[-4:-1]
+    rows = ((pairs_i // n) * m + ts) * n + pairs_i % n
+    segs = ((pairs_k // n) * m + ts) * n + pairs_k % n
+    hit = geometry.get_hit_rays_pairs(heli_as.reshape((-1, 2)),
+        heli_bs.reshape((-1, 2)), starts.reshape((-1, rays, 2)),
+        ends.reshape((-1, rays, 2)), rows, segs)
+    return hit.reshape(starts.shape[:-1])
+
+def get_masks(plant, sun_angles):
+    ''' Returns the not shaded, not blocked and not missed rays of shape
+    (m, n, heli_rays) and the heliostats sun vectors and normals of shape
+    (m, n, 2), with a leading dimension for a Population of layouts. Only
+    the pairs of heliostats that can interact are tested, see
+    Plant.get_windows. '''
+    with profiling.phase("ray_points"):
+        heli_suns, heli_normals, heli_as, heli_bs, surf_points, ref_ends, sun_ends = \
+            get_geometry(plant, sun_angles)
+
+    (pairs_i, pairs_k, centers, half_widths), (block_i, block_k) = \
+        plant.get_windows(State.d_factor)
+    not_shaded = np.ones(surf_points.shape[:-1], dtype=bool)
+    not_blocked = np.ones(surf_points.shape[:-1], dtype=bool)
+
+    ## chunks of the sun angles with about MAX_PAIRS tests of the rays as
+    ## in geometry.get_hit_rays, a window of half width w is active in
+    ## w / pi of the sun angles
+    m, leading = len(sun_angles), heli_as.ndim - 3
+    pairs = len(block_i) + np.sum(np.minimum(half_widths, np.pi)) / np.pi
+    chunk = max(1, int(geometry.MAX_PAIRS // max(1, pairs * plant.heli_rays)))
+    for t0 in range(0, m, chunk):
+        t1 = min(m, t0 + chunk)
+        angles = (slice(None),) * leading + (slice(t0, t1),)
+        with profiling.phase("shading"):
+            ts, active = geometry.get_active_pairs(centers, half_widths,
+                                                   sun_angles[t0:t1])
+            not_shaded[angles] = ~get_hit_rays_pairs(heli_as[angles],
+                heli_bs[angles], surf_points[angles], sun_ends[angles],
+                ts, pairs_i[active], pairs_k[active])
+        with profiling.phase("blocking"):
+            ts = np.repeat(np.arange(t1 - t0), len(block_i))
+            not_blocked[angles] = ~get_hit_rays_pairs(heli_as[angles],
+                heli_bs[angles], surf_points[angles], ref_ends[angles],
+                ts, np.tile(block_i, t1 - t0), np.tile(block_k, t1 - t0))
+    with profiling.phase("missed"):
+        not_missed = geometry.intersect(plant.rec_a, plant.rec_b, surf_points, ref_ends)
+    if profiling.active:
+        profiling.count("intersection_tests", not_missed.size)
+        profiling.count("early_exits", not_shaded.size - np.count_nonzero(not_shaded))
+        profiling.count("early_exits", not_blocked.size - np.count_nonzero(not_blocked))
+
+    return not_shaded, not_blocked, not_missed, heli_suns, heli_normals
+
+def get_effects(plant, heli_suns, heli_normals):
+    ''' Returns eta_aa and eta_cos of shape (m,). As in State.get_effects,
+    the first heliostat is used for eta_aa and eta_cos. '''
+    eta_aa = plant.heli_aas[..., 0]
+    eta_cos = np.sum((heli_normals[..., 0, :] - plant.layout[..., 0, :]) * \
+                     (heli_suns[..., 0, :] - plant.layout[..., 0, :]), axis=-1)
+    return eta_aa, eta_cos
+
+def sum_powers(eta_aa, eta_cos, eta_sbm):
+    ''' Returns the powers of shape (m,), the heliostats are accumulated in
+    order as in utils.get_power so the results are the same. '''
+    terms = (eta_aa * eta_cos)[..., None] * eta_sbm
+    return np.cumsum(terms, axis=-1)[..., -1]
+
+def mean_heliostats(values):
+    ''' Returns the means of values of shape (m, n) over the heliostats, they
+    are accumulated in order as in utils.get_power so the results are the
+    same. '''
+    return np.cumsum(values.astype(float), axis=-1)[..., -1] / values.shape[-1]
+
+def get_intervals(plant, mirrors, rows, segments):
+    ''' Returns the intervals of get_fractions of the rays of heliostats rows
+    against heliostats segments, sorted index arrays of shape (r,) and (q,),
+    for the mirrors of geometry.get_mirrors, as (starts, ends) of:
+        * shaded of shape (..., r, q), hitting the segments along the sun
+        * blocked of shape (..., r, q), hitting them along the reflection
+        * hit of shape (..., r, 1), hitting the receiver
+    '''
+    heli_suns, heli_normals, heli_tans, heli_as, heli_bs = mirrors
+    layout = plant.layout[..., rows, :]
+    origins = heli_bs[..., rows, :]
+    us = heli_tans[..., rows, :] * plant.heli_size
+    sun_vecs = heli_suns[..., rows, :] - layout
+    ref_vecs = np.broadcast_to(plant.heli_refs[..., rows, :] - layout, us.shape)
+    sun_lengths = np.broadcast_to(plant.max_ij * State.d_factor, us.shape[:-1])
+    ref_lengths = np.broadcast_to(plant.ref_lengths[..., rows] * State.d_factor,
+                                  us.shape[:-1])
+
+    ## own segment of each row, -1 if it is not among the segments
+    positions = np.minimum(np.searchsorted(segments, rows), len(segments) - 1)
+    own = np.where(segments[positions] == rows, positions, -1)
+    seg_as, seg_bs = heli_as[..., segments, :], heli_bs[..., segments, :]
+    with profiling.phase("shading"):
+        shaded = geometry.get_hit_intervals(origins, us, sun_vecs, sun_lengths,
+                                            seg_as, seg_bs, own)
+    with profiling.phase("blocking"):
+        blocked = geometry.get_hit_intervals(origins, us, ref_vecs, ref_lengths,
+                                             seg_as, seg_bs, own)
+    with profiling.phase("missed"):
+        hit = geometry.get_hit_intervals(origins, us, ref_vecs, ref_lengths,
+                                         plant.rec_a[None], plant.rec_b[None])
+    return shaded, blocked, hit
+
+def get_received(shaded, blocked, hit):
+    ''' Returns the received fractions of the intervals of get_intervals,
+    the part that hits the receiver and is not shaded or blocked, and the
+    fractions that hit the receiver. '''
+    lo = np.full(hit[0].shape[:-1], geometry.SURF_SPAN[0])
+    hi = np.full(hit[0].shape[:-1], geometry.SURF_SPAN[1])
+    span = geometry.SURF_SPAN[1] - geometry.SURF_SPAN[0]
+    hit_lo = np.clip(hit[0][..., 0], lo, hi)
+    hit_hi = np.maximum(np.clip(hit[1][..., 0], lo, hi), hit_lo)
+    lost = geometry.get_union_length(
+        np.concatenate((shaded[0], blocked[0]), axis=-1),
+        np.concatenate((shaded[1], blocked[1]), axis=-1), hit_lo, hit_hi)
+    return (hit_hi - hit_lo - lost) / span, (hit_hi - hit_lo) / span
+
+def get_fractions(plant, sun_angles):
+    ''' Returns the exact fractions of the heliostats surface covered by the
+    rays, see geometry.SURF_SPAN, instead of sampling it with the rays:
+        * eta_sbm of shape (m, n), the received fractions
+        * sbms of shape (m, n, 3), the shaded, blocked and missed fractions
+    and the heliostats sun vectors and normals of shape (m, n, 2). The
+    shaded part of a heliostat is the union of the intervals of the other
+    heliostats projected along the sun rays, similarly for the blocked and
+    missed parts. The fractions are continuous in the layout.
+    '''
+    with profiling.phase("ray_points"):
+        mirrors = geometry.get_mirrors(plant.layout, plant.heli_refs,
+                                       sun_angles, plant.heli_size)
+    heli_suns, heli_normals = mirrors[:2]
+    every = np.arange(plant.n)
+    shaded, blocked, hit = get_intervals(plant, mirrors, every, every)
+    eta_sbm, eta_hit = get_received(shaded, blocked, hit)
+
+    lo = np.full(eta_sbm.shape, geometry.SURF_SPAN[0])
+    hi = np.full(eta_sbm.shape, geometry.SURF_SPAN[1])
+    span = geometry.SURF_SPAN[1] - geometry.SURF_SPAN[0]
+    sbms = np.stack((geometry.get_union_length(*shaded, lo, hi) / span,
+                     geometry.get_union_length(*blocked, lo, hi) / span,
+                     1 - eta_hit), axis=-1)
+    return eta_sbm, sbms, heli_suns, heli_normals
+
+def get_powers(plant, sun_angles, do_stats=True, exact=False, out=None):
+    ''' Returns for each of the m sun angles the same agregates as
+    utils.get_power:
+        * powers of shape (m,)
+        * etas_means of shape (m, 3)
+        * sbms_props of shape (m, 3)
+    If exact, the exact fractions of get_fractions are used instead of the
+    rays. With out, a mapping of records.COLUMNS to arrays of shape (m,),
+    the powers and the stats are written to out instead, and etas_means and
+    sbms_props are None.
+    '''
+    m = len(sun_angles)
+    etas_means, sbms_props = None, None
+    if out is not None:
+        powers, do_stats = out["power"], True
+    else:
+        powers = np.zeros(m)
+        if do_stats:
+            etas_means = np.zeros((m, 3))
+            sbms_props = np.zeros((m, 3))
+            out = dict(zip(records.ETA_COLUMNS + records.SBM_COLUMNS,
+                           list(etas_means.T) + list(sbms_props.T)))
+
+    if exact:
+        chunk = max(1, geometry.MAX_PAIRS // max(1, plant.n * plant.n))
+    else:
+        chunk = get_angles_chunk(plant)
+    for t0 in range(0, m, chunk):
+        t1 = min(m, t0 + chunk)
+        if exact:
+            eta_sbm, sbms, heli_suns, heli_normals = \
+                get_fractions(plant, sun_angles[t0:t1])
+        else:
+            not_shaded, not_blocked, not_missed, heli_suns, heli_normals = \
+                get_masks(plant, sun_angles[t0:t1])
+            received = np.sum(not_shaded & not_blocked & not_missed, axis=-1)
+            eta_sbm = received / plant.heli_rays
+
+        eta_aa, eta_cos = get_effects(plant, heli_suns, heli_normals)
+        powers[t0:t1] = sum_powers(eta_aa, eta_cos, eta_sbm)
+
+        if do_stats:
+            ## eta_aa and eta_cos of the first heliostat for all heliostats
+            for column, etas in zip(records.ETA_COLUMNS,
+                                    [eta_aa, eta_cos[:, None], eta_sbm]):
+                etas = np.broadcast_to(etas, eta_sbm.shape)
+                out[column][t0:t1] = mean_heliostats(etas)
+            if exact:
+                sbms_means = np.mean(sbms, axis=1)
+                for j, column in enumerate(records.SBM_COLUMNS):
+                    out[column][t0:t1] = sbms_means[:, j]
+            else:
+                rays = plant.n * plant.heli_rays
+                for column, not_sbm in zip(records.SBM_COLUMNS,
+                                           [not_shaded, not_blocked, not_missed]):
+                    out[column][t0:t1] = (rays - np.count_nonzero(not_sbm, axis=(1, 2))) / rays
+
+    return powers, etas_means, sbms_props
+
+def get_energies(plant, layouts, sun_angles, exact=False, weights=None):
+    ''' Returns the energies of shape (S,) for layouts of shape (S, n, 2) of
+    the plant, the same as the sum of get_powers for each layout, weighted
+    by weights of the sun angles if given. The layouts are evaluated
+    together in groups of at most POPULATION_RAYS rays as a Population,
+    with all the sun angles and the windows of the group at once, or one by
+    one if exact. '''
+    m, n = len(sun_angles), len(layouts[0])
+    if weights is None:
+        weights = np.ones(m)
+    energies = np.zeros(len(layouts))
+    group = max(1, POPULATION_RAYS // max(1, m * n * plant.heli_rays))
+    if exact:
+        group = 1
+    for s0 in range(0, len(layouts), group):
+        s1 = min(len(layouts), s0 + group)
+        if s1 - s0 == 1:
+            scratch = copy.copy(plant)
+            scratch.layout = np.array(layouts[s0])
+            scratch.set_layout()
+            powers = get_powers(scratch, sun_angles, do_stats=False, exact=exact)[0]
+            energies[s0] = np.sum(weights * powers)
+            continue
+
+        population = Population(plant, layouts[s0:s1])
+        not_shaded, not_blocked, not_missed, heli_suns, heli_normals = \
+            get_masks(population, sun_angles)
+        received = np.sum(not_shaded & not_blocked & not_missed, axis=-1)
+        eta_sbm = received / plant.heli_rays
+        eta_aa, eta_cos = get_effects(population, heli_suns, heli_normals)
+        powers = sum_powers(eta_aa, eta_cos, eta_sbm).astype(float)
+        energies[s0:s1] = np.sum(weights * powers, axis=1)
+    return energies
+
+def get_moved_energies(plant, moves, positions, sun_angles, weights=None):
+    ''' Returns the energies of shape (K,) of the layouts of the plant with
+    heliostat moves[k] moved to positions[k], the same as get_energies with
+    exact of these layouts. Only the intervals of the moved heliostat and
+    the fractions of the heliostats whose intervals changed are computed
+    for each layout, the others are shared with the layout of the plant.
+    The layouts in which the move changes max_ij, the length of all the sun
+    rays, are evaluated as a whole. '''
+    m, n = len(sun_angles), plant.n
+    if weights is None:
+        weights = np.ones(m)
+    base = copy.copy(plant)
+    base.layout = np.array(plant.layout, dtype=float)
+    base.set_layout()
+    scratches = []
+    for i, position in zip(moves, positions):
+        scratch = copy.copy(base)
+        scratch.layout = base.layout.copy()
+        scratch.layout[i] = position
+        scratch.set_layout()
+        scratches.append(scratch)
+
+    powers = np.zeros((len(moves), m))
+    local = []
+    for k, scratch in enumerate(scratches):
+        if scratch.max_ij == base.max_ij:
+            local.append(k)
+        else:
+            powers[k] = get_powers(scratch, sun_angles, do_stats=False, exact=True)[0]
+
+    every = np.arange(n)
+    chunk = max(1, geometry.MAX_PAIRS // max(1, n * n))
+    for t0 in range(0, m, chunk):
+        t1 = min(m, t0 + chunk)
+        mirrors = geometry.get_mirrors(base.layout, base.heli_refs,
+                                       sun_angles[t0:t1], base.heli_size)
+        shaded, blocked, hit = get_intervals(base, mirrors, every, every)
+        eta_sbm = get_received(shaded, blocked, hit)[0]
+        for k in local:
+            i, scratch = moves[k], scratches[k]
+            moved = geometry.get_mirrors(scratch.layout[i:i + 1],
+                scratch.heli_refs[i:i + 1], sun_angles[t0:t1], scratch.heli_size)
+            moved_mirrors = [np.array(part) for part in mirrors]
+            for part, moved_part in zip(moved_mirrors, moved):
+                part[:, i] = moved_part[:, 0]
+            row = get_intervals(scratch, moved_mirrors, np.array([i]), every)
+            column = get_intervals(scratch, moved_mirrors, every, np.array([i]))
+
+            ## heliostat i and the heliostats with a changed interval of i in
+            ## each sun angle
+            changed = np.zeros(eta_sbm.shape, dtype=bool)
+            changed[:, i] = True
+            for new, old in zip(column[:2], (shaded, blocked)):
+                for new_part, old_part in zip(new, old):
+                    changed |= new_part[..., 0] != old_part[..., i]
+            ts, js = np.nonzero(changed)
+            own = js == i
+
+            ## their intervals with the new column and row of heliostat i
+            intervals = [(old[0][ts, js], old[1][ts, js])
+                         for old in (shaded, blocked, hit)]
+            for (starts, ends), new in zip(intervals[:2], column[:2]):
+                starts[:, i] = new[0][ts, js, 0]
+                ends[:, i] = new[1][ts, js, 0]
+            for (starts, ends), new in zip(intervals, row):
+                starts[own] = new[0][ts[own], 0]
+                ends[own] = new[1][ts[own], 0]
+            moved_sbm = eta_sbm.copy()
+            moved_sbm[ts, js] = get_received(*intervals)[0]
+
+            eta_aa, eta_cos = get_effects(scratch, moved_mirrors[0], moved_mirrors[1])
+            powers[k, t0:t1] = sum_powers(eta_aa, eta_cos, moved_sbm)
+    return np.sum(weights * powers, axis=1)
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bench-imports.py - cold start time of the simulation core in a new
+    process, as in each worker process or short command line call. Fails if
+    the best time is above the budget in seconds or if the core imports
+    matplotlib, pandas or scipy.
+
+    Usage:
+        bench-imports.py [budget] """
+
+import sys
+import json
+import subprocess
+
+## modules of the compute path and modules they must not import
+CORE = ["plant", "sun", "state", "batch", "geometry", "evaluator", "utils",
+        "cache", "store"]
+HEAVY = ["matplotlib", "pandas", "scipy"]
+
+## measured in the new process: import the core and evaluate a layout
+SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {core}
+imported = time.perf_counter()
+plant = plant.Plant()
+plant.layout = utils.grid_layout(plant, 5)
+plant.set_layout()
+utils.get_energy(plant)
+evaluated = time.perf_counter()
+print(json.dumps({{"import": imported - start, "first_energy": evaluated - imported,
+                  "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+def measure(repeat=5):
+    ''' Returns the best import and first energy times of repeat new
+    processes and the heavy modules they imported. '''
+    script = SCRIPT.format(core=", ".join(CORE), heavy=HEAVY)
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script], check=True,
+                             capture_output=True, text=True).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+    return min(run["import"] for run in runs), \
+           min(run["first_energy"] for run in runs), runs[0]["heavy"]
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.3
+    import_time, energy_time, heavy = measure()
+    print("import of the core: {:.3f} s (budget {:.3f} s)".format(import_time, budget))
+    print("first energy:       {:.3f} s".format(energy_time))
+    print("heavy modules:      {}".format(", ".join(heavy) if heavy else "none"))
+    if import_time > budget or heavy:
+        print("FAILED")
+        sys.exit(1)
+    print("OK")
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bench-population.py - energies of many layouts with utils.get_energies,
+    evaluated together as a batch.Population, against get_energy of each
+    layout in a loop, on Tiny and Hypothetical plants. The population shares
+    the sun angles, the windows and the Python overhead of the layouts, so
+    it pays off for small layouts with few rays per heliostat.
+
+    Usage:
+        bench-population.py [layouts] """
+
+import sys
+import time
+import numpy as np
+from plant import Plant
+import utils
+
+CONFIGS = [("tiny", "float128", 5), ("tiny", "float64", 5),
+           ("hypo", "float128", 5), ("hypo", "float64", 5),
+           ("hypo", "float128", 20), ("hypo", "float64", 20)]
+
+def time_loop(plant, layouts):
+    start = time.perf_counter()
+    energies = []
+    for layout in layouts:
+        plant.layout = layout
+        plant.set_layout()
+        energies.append(utils.get_energy(plant))
+    return time.perf_counter() - start, np.array(energies)
+
+def time_population(plant, layouts):
+    start = time.perf_counter()
+    energies = utils.get_energies(plant, layouts)
+    return time.perf_counter() - start, energies
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    print("{:>6s} {:>9s} {:>4s} {:>10s} {:>16s} {:>8s} {:>6s}".format(
+        "plant", "precision", "n", "loop [s]", "population [s]", "speedup", "same"))
+    for name, precision, n in CONFIGS:
+        plant = Plant(plant_d=utils.load("../data/plants/{}-plant.json".format(name)),
+                      precision=precision)
+        layouts = [utils.grid_layout(plant, n, jitter=0.4, seed=s)
+                   for s in range(count)]
+        t_loop, loop = time_loop(plant, layouts)
+        t_population, population = time_population(plant, layouts)
+        print("{:>6s} {:>9s} {:4d} {:10.3f} {:16.3f} {:8.2f} {:>6s}".format(
+            name, precision, n, t_loop, t_population, t_loop / t_population,
+            str(np.array_equal(loop, population))))
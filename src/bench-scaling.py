@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bench-scaling.py - scaling of a State with the interaction windows of
+    Plant.get_windows and with the spatial index, State(grid=True), on
+    Hypothetical plant with the field area scaled up with n. The time of the
+    windows includes their construction, once for each layout. """
+
+import sys
+import time
+import numpy as np
+from plant import Plant
+from state import State
+import utils
+
+def get_plant(n, plant_d):
+    ''' Returns the plant with field area scaled so that the density of
+    heliostats is the same as for 100 heliostats on Hypothetical plant. '''
+    scale = np.sqrt(n / 100)
+    plant_d["field_area"]["x_max"] = 100 * scale
+    plant_d["field_area"]["y_max"] = 20 * scale
+    plant = Plant(plant_d=plant_d)
+    plant.layout = utils.grid_layout(plant, n, jitter=0.3, seed=n)
+    plant.set_layout()
+    return plant
+
+def time_state(plant, sun_angle, grid):
+    start = time.perf_counter()
+    state = State(plant, sun_angle, grid=grid)
+    return time.perf_counter() - start, state
+
+if __name__ == "__main__":
+    ## the windows are skipped for larger fields, their number grows as
+    ## n**2, unless: bench-scaling.py all
+    max_windows = np.inf if "all" in sys.argv[1:] else 2000
+    plant_d = utils.load("../data/plants/hypo-plant.json")
+    sun_angle = np.radians(60)
+
+    print("{:>6s} {:>11s} {:>10s} {:>8s} {:>6s}".format(
+        "n", "windows [s]", "grid [s]", "ratio", "same"))
+    for n in [10, 30, 100, 300, 1000, 3000, 10000]:
+        plant = get_plant(n, plant_d)
+        t_grid, state_grid = time_state(plant, sun_angle, grid=True)
+        if n <= max_windows:
+            t_windows, state_windows = time_state(plant, sun_angle, grid=False)
+            same = np.array_equal(state_windows.not_shaded, state_grid.not_shaded) and \
+                np.array_equal(state_windows.not_blocked, state_grid.not_blocked) and \
+                np.array_equal(state_windows.not_missed, state_grid.not_missed)
+            print("{:6d} {:11.4f} {:10.4f} {:8.1f} {:>6s}".format(
+                n, t_windows, t_grid, t_windows / t_grid, str(same)))
+        else:
+            print("{:6d} {:>11s} {:10.4f} {:>8s} {:>6s}".format(
+                n, "-", t_grid, "-", "-"))
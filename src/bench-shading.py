@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bench-shading.py - compares the vectorized shading and blocking tests
+    in State with the original per-ray, per-heliostat loops. """
+
+import time
+import numpy as np
+from plant import Plant
+from state import State
+import utils
+
+def get_not_sb_loop(state, i, end_points):
+    ''' The original implementation of State.get_not_sb. '''
+    not_sb = np.ones(state.plant.heli_rays, dtype=int)
+    for j in range(state.plant.heli_rays):
+        for k in range(state.plant.n):
+            if k != i:
+                a, b = state.heli_as[k, :], state.heli_bs[k, :]
+                c, d = state.surf_points[i, j, :], end_points[i, j, :]
+                if state.intersect(a, b, c, d):
+                    not_sb[j] = 0
+                    break
+    return not_sb
+
+def time_loop(state):
+    start = time.perf_counter()
+    not_shaded = np.array([get_not_sb_loop(state, i, state.sun_ends)
+                           for i in range(state.plant.n)])
+    not_blocked = np.array([get_not_sb_loop(state, i, state.ref_ends)
+                            for i in range(state.plant.n)])
+    return time.perf_counter() - start, not_shaded, not_blocked
+
+def time_vectorized(state):
+    start = time.perf_counter()
+    not_shaded = state.get_not_sb_all(state.sun_ends)
+    not_blocked = state.get_not_sb_all(state.ref_ends)
+    return time.perf_counter() - start, not_shaded, not_blocked
+
+if __name__ == "__main__":
+    plant_d = utils.load("../data/plants/hypo-plant.json")
+    sun_angle = np.radians(60)
+
+    print("{:>6s} {:>6s} {:>10s} {:>10s} {:>8s} {:>6s}".format(
+        "n", "rays", "loop [s]", "vec [s]", "speedup", "same"))
+    for n in [5, 20, 50, 100]:
+        for heli_rays in [5, 50, 200]:
+            plant_d["heliostats"]["heli_rays"] = heli_rays
+            plant = Plant(plant_d=plant_d)
+            plant.layout = utils.grid_layout(plant, n, jitter=0.3, seed=n)
+            plant.set_layout()
+            state = State(plant, sun_angle)
+
+            t_loop, shaded_loop, blocked_loop = time_loop(state)
+            t_vec, shaded_vec, blocked_vec = time_vectorized(state)
+            same = np.array_equal(shaded_loop, shaded_vec) and \
+                np.array_equal(blocked_loop, blocked_vec)
+            print("{:6d} {:6d} {:10.4f} {:10.4f} {:8.1f} {:>6s}".format(
+                n, heli_rays, t_loop, t_vec, t_loop / t_vec, str(same)))
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bench-suite.py - times State construction, get_power and get_energy on
+    Hypothetical plant over the number of heliostats n, the number of rays
+    heli_rays and the number of sun angles m.
+
+    Usage:
+        bench-suite.py [engine] [full]     runs the suite and saves the results
+            to ../data/results/bench-suite-<engine>.json
+        bench-suite.py compare old.json new.json
+            compares the times of two saved results
+
+    Configurations with more than MAX_WORK segment intersection tests are
+    skipped, unless full is given. """
+
+import sys
+import time
+import platform
+import tracemalloc
+import numpy as np
+from plant import Plant
+from state import State
+from sun import Sun
+import utils
+
+NS = [5, 20, 100, 500, 2000]
+HELI_RAYS = [5, 50, 200]
+SUN_STEPS = [17, 180, 720]
+MAX_WORK = 1e8
+
+def get_plant(plant_d, n, heli_rays):
+    ''' Returns Hypothetical plant with a grid layout of n heliostats. '''
+    plant_d["heliostats"]["heli_rays"] = heli_rays
+    plant = Plant(plant_d=plant_d)
+    plant.layout = utils.grid_layout(plant, n, jitter=0.3, seed=n)
+    plant.set_layout()
+    return plant
+
+def measure(f, min_time=0.2):
+    ''' Returns the best time of f over repeated calls that take at least
+    min_time seconds in total, the number of calls and the peak memory of
+    one call in bytes. '''
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    while not times or (sum(times) < min_time and len(times) < 100):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times), len(times), peak
+
+def run_suite(engine, full=False):
+    plant_d = utils.load("../data/plants/hypo-plant.json")
+    sun_angle = np.radians(60)
+    results = []
+
+    print("{:>6s} {:>6s} {:>5s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+        "n", "rays", "m", "state [s]", "power [s]", "energy [s]", "evals/s", "peak [MB]"))
+    for n in NS:
+        for heli_rays in HELI_RAYS:
+            plant = get_plant(plant_d, n, heli_rays)
+            if not full and n * n * heli_rays > MAX_WORK:
+                continue
+            state_time, _, state_peak = measure(lambda: State(plant, sun_angle))
+            state = State(plant, sun_angle)
+            power_time, _, power_peak = measure(
+                lambda: utils.get_power(plant, state))
+
+            for m in SUN_STEPS:
+                record = {"n": n, "heli_rays": heli_rays, "m": m,
+                          "state_time": state_time, "state_peak": state_peak,
+                          "power_time": power_time, "power_peak": power_peak,
+                          "energy_time": None, "energy_peak": None,
+                          "energy_calls": 0, "evals_per_second": None}
+                work = n * n * heli_rays * m
+                if full or work <= MAX_WORK:
+                    sun = Sun(m)
+                    energy_time, calls, energy_peak = measure(lambda:
+                        utils.get_energy(plant, engine=engine, sun=sun))
+                    record.update({"energy_time": energy_time,
+                                   "energy_peak": energy_peak,
+                                   "energy_calls": calls,
+                                   "evals_per_second": 1 / energy_time})
+                    print("{:6d} {:6d} {:5d} {:10.4f} {:10.4f} {:10.4f} {:10.1f} {:10.1f}".format(
+                        n, heli_rays, m, state_time, power_time, energy_time,
+                        1 / energy_time, energy_peak / 2**20))
+                else:
+                    print("{:6d} {:6d} {:5d} {:10.4f} {:10.4f} {:>10s} {:>10s} {:>10s}".format(
+                        n, heli_rays, m, state_time, power_time, "-", "-", "-"))
+                results.append(record)
+
+    return {"engine": engine,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results}
+
+def compare(old, new):
+    ''' Prints the ratios of the times of new to old for the configurations
+    that are in both, ratios above 1 are slowdowns. '''
+    key = lambda record: (record["n"], record["heli_rays"], record["m"])
+    old_records = {key(record): record for record in old["results"]}
+
+    print("{} -> {}".format(old["engine"], new["engine"]))
+    print("{:>6s} {:>6s} {:>5s} {:>8s} {:>8s} {:>8s}".format(
+        "n", "rays", "m", "state", "power", "energy"))
+    for record in new["results"]:
+        if key(record) not in old_records:
+            continue
+        old_record = old_records[key(record)]
+        ratios = []
+        for name in ["state_time", "power_time", "energy_time"]:
+            if record[name] and old_record[name]:
+                ratios.append("{:8.2f}".format(record[name] / old_record[name]))
+            else:
+                ratios.append("{:>8s}".format("-"))
+        print("{:6d} {:6d} {:5d} {}".format(*key(record), " ".join(ratios)))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args and args[0] == "compare":
+        compare(utils.load(args[1]), utils.load(args[2]))
+    else:
+        engine = args[0] if args and args[0] != "full" else "batch"
+        suite = run_suite(engine, full=("full" in args))
+        utils.save(suite, "../data/results/bench-suite-{}.json".format(engine),
+                   indent=1)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" bound.py - upper bound of the energy that ignores the interactions of
+    heliostats, to skip layouts that can not beat the best one found. """
+
+import copy
+import numpy as np
+import geometry
+from sun import Sun
+import utils
+
+class EnergyBound:
+    ''' Upper bound of utils.get_energy of the plant for any layout.
+
+    In the energy model the power in each sun angle is the sum over the
+    heliostats of eta_aa * eta_cos * eta_sbm, where eta_aa and eta_cos are
+    of the first heliostat, see State.get_effects, and eta_sbm <= 1. So the
+    energy of a layout is at most n * B(layout[0]), where
+        B(p) = sum_t sun.weights[t] * eta_aa(p) * eta_cos(p, t)
+    is tabulated on a grid over the field with spacing step. The bound of a
+    position is the maximum of B in the corners of its cell plus the slack,
+    the largest excess of B inside the cells over their corners found on a
+    finer grid.
+
+    For example:
+        bound = EnergyBound(plant)
+        if bound.get_bound(layout) > best_energy:
+            energy = utils.get_energy(plant)
+    '''
+    def __init__(self, plant, sun=None, step=1.0):
+        if sun is None:
+            sun = Sun(180)
+        self.plant = copy.copy(plant)
+        self.sun = sun
+        self.xs = np.linspace(plant.x_min, plant.x_max,
+            max(2, int(np.ceil((plant.x_max - plant.x_min) / step)) + 1))
+        self.ys = np.linspace(plant.y_min, plant.y_max,
+            max(2, int(np.ceil((plant.y_max - plant.y_min) / step)) + 1))
+        self.table = self.get_position_bounds(
+            np.stack(np.meshgrid(self.xs, self.ys, indexing="ij"), axis=-1))
+
+        ## excess of B in the cells over their corners, on a 3 times finer grid
+        xs = np.linspace(plant.x_min, plant.x_max, 3 * (len(self.xs) - 1) + 1)
+        ys = np.linspace(plant.y_min, plant.y_max, 3 * (len(self.ys) - 1) + 1)
+        points = np.stack(np.meshgrid(xs, ys, indexing="ij"), axis=-1)
+        fine = self.get_position_bounds(points)
+        self.slack = 0.0
+        self.slack = max(0.0, np.max(fine - self.lookup(points)))
+
+    def get_position_bounds(self, points):
+        ''' Returns B(p) of the points of shape (..., 2), computed with the
+        same formulas as State. '''
+        shape = points.shape[:-1]
+        self.plant.layout = points.reshape((-1, 2))
+        self.plant.set_layout()
+        heli_suns, heli_normals, heli_tans, heli_as, heli_bs = \
+            geometry.get_mirrors(self.plant.layout, self.plant.heli_refs,
+                                 self.sun.angles, self.plant.heli_size)
+        eta_cos = np.sum((heli_normals - self.plant.layout) * \
+                         (heli_suns - self.plant.layout), axis=-1)
+        bounds = np.sum(self.sun.weights[:, None] * self.plant.heli_aas * \
+                        np.maximum(eta_cos, 0), axis=0)
+        return bounds.astype(float).reshape(shape)
+
+    def lookup(self, points):
+        ''' Returns the bounds of B of the points of shape (..., 2) from the
+        table, the points are clipped to the field area. '''
+        i = np.searchsorted(self.xs, points[..., 0], side="right") - 1
+        j = np.searchsorted(self.ys, points[..., 1], side="right") - 1
+        i = np.clip(i, 0, len(self.xs) - 2)
+        j = np.clip(j, 0, len(self.ys) - 2)
+        corners = np.maximum(
+            np.maximum(self.table[i, j], self.table[i + 1, j]),
+            np.maximum(self.table[i, j + 1], self.table[i + 1, j + 1]))
+        return corners + self.slack
+
+    def get_bound(self, layout):
+        ''' Returns the upper bound of the energy of the layout. '''
+        layout = np.asarray(layout, dtype=float)
+        return len(layout) * self.lookup(layout[0]) * (1 + 1e-9)
+
+    def get_bounds(self, layouts):
+        ''' Returns the upper bounds of the energies of layouts of shape
+        (S, n, 2). '''
+        layouts = np.asarray(layouts, dtype=float)
+        return layouts.shape[1] * self.lookup(layouts[:, 0]) * (1 + 1e-9)
+
+def get_best(layouts, plant_d, bound, block=None, **kwargs):
+    ''' Returns the best energy of the valid layouts, its index and the
+    number of evaluated layouts. The layouts are evaluated with
+    utils.evaluate_many in blocks in the order of decreasing bounds,
+    skipping the layouts with bound below the best energy so far. '''
+    bounds = bound.get_bounds(layouts)
+    order = np.argsort(-bounds, kind="stable")
+    if block is None:
+        block = max(1, len(layouts) // 20)
+    best_energy, best_index, n_evaluated = -np.inf, None, 0
+    for b0 in range(0, len(layouts), block):
+        indices = order[b0:b0 + block]
+        indices = indices[bounds[indices] > best_energy]
+        if len(indices) == 0:
+            ## the remaining bounds are lower
+            break
+        energies, valid = utils.evaluate_many([layouts[k] for k in indices],
+            plant_d, skip_invalid=True, **kwargs)
+        n_evaluated += int(np.sum(valid))
+        if np.any(valid) and np.nanmax(energies) > best_energy:
+            best = np.nanargmax(energies)
+            best_energy, best_index = energies[best], indices[best]
+    return best_energy, best_index, n_evaluated
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" cache.py - memoizing cache of energies for optimizers that evaluate the
+    same or nearly the same layouts many times. """
+
+import functools
+import json
+from collections import OrderedDict
+import numpy as np
+from sun import Sun
+from store import DEFAULT_OPTIONS
+import utils
+
+class EnergyCache:
+    ''' Least recently used cache of at most maxsize energies. The layouts are
+    rounded to multiples of tol, so layouts closer than tol share the same
+    energy. Use get_energy in place of utils.get_energy, the energies that
+    are not cached are looked up in the optional store.ResultStore first:
+        cache = EnergyCache()
+        cache.get_energy(plant, engine="interval")
+
+    or decorate the objective function of an optimizer, the arguments are
+    rounded the same way:
+        @cache
+        def f(x):
+            ...
+    '''
+    def __init__(self, maxsize=100000, tol=1e-9, store=None):
+        self.maxsize = maxsize
+        self.tol = tol
+        self.store = store
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, *parts):
+        ''' Returns a hashable key of the arrays and the other parts. '''
+        key = []
+        for part in parts:
+            if isinstance(part, (np.ndarray, list, tuple)):
+                part = np.asarray(part, dtype=float)
+                part = np.round(part / self.tol).astype(np.int64)
+                key.append((part.shape, part.tobytes()))
+            else:
+                key.append(part)
+        return tuple(key)
+
+    def lookup(self, key, compute):
+        ''' Returns the value of key, calls compute() if key is not cached. '''
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        value = compute()
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def get_energy(self, plant, **kwargs):
+        ''' Returns utils.get_energy(plant, **kwargs) of the current layout of
+        the plant. The stats are not cached, so do_stats is not supported. The
+        key hashes the sun model and the options as store.ResultStore.get_key. '''
+        spec = json.dumps(plant.get_spec(), sort_keys=True)
+        options = {key: value for key, value in kwargs.items()
+                   if key not in ("verbose", "sun")}
+        options = repr(sorted(dict(DEFAULT_OPTIONS, **options).items()))
+        sun = kwargs.get("sun")
+        if sun is None:
+            sun = Sun(180)
+        key = self.get_key(spec, options, np.asarray(sun.angles, dtype=float).tobytes(),
+                           np.asarray(sun.weights, dtype=float).tobytes(), plant.layout)
+        evaluate = utils.get_energy if self.store is None else self.store.get_energy
+        return self.lookup(key, lambda: evaluate(plant, **kwargs))
+
+    def __call__(self, f):
+        ''' Returns f with the values cached by the rounded arguments. '''
+        @functools.wraps(f)
+        def wrapper(*args):
+            key = self.get_key(f.__module__, f.__qualname__, *args)
+            return self.lookup(key, lambda: f(*args))
+        return wrapper
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        calls = self.hits + self.misses
+        return "EnergyCache: {} hits, {} misses ({:.1f}% hits), {} of {} entries".format(
+            self.hits, self.misses, 100 * self.hits / max(1, calls),
+            len(self.entries), self.maxsize)
@@ -6,13 +6,25 @@ import numpy as np
 from scipy import optimize
 from plant import Plant
 import utils
+from cache import EnergyCache
 import time
 
+## repeated evaluations of the same layout are cached
+cache = EnergyCache()
+
+@cache
 def f(x):
-    plant.layout = x.reshape((5, 2))
+    plant.layout = x.reshape((-1, 2))
     plant.set_layout()
     return -utils.get_energy(plant)
 
+def clearances(x):
+    ''' Minimum distances constraints, non negative if the heliostats are
+    at least d_min apart and from the receiver. '''
+    plant.layout = x.reshape((-1, 2))
+    plant.set_layout()
+    return plant.get_clearances()
+
 if __name__ == "__main__":
     ## Tiny plant, n=5 heliostats
     plant = Plant()
@@ -35,6 +47,7 @@ if __name__ == "__main__":
              'fun': lambda x, ub=upper, i=factor: ub - x[i]}
         cons.append(l)
         cons.append(u)
+    cons.append({'type': 'ineq', 'fun': clearances})
 
     ## initial guess
     x0 = utils.load("../data/layouts/random-layout.json")
@@ -73,4 +86,5 @@ if __name__ == "__main__":
     print(plant.valid_layout)
     print(utils.get_energy(plant))
 
+    print(cache)
     utils.save_layout(x[:, 0], x[:, 1], "cobyla-layout")
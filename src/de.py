@@ -26,10 +26,16 @@ class MinimizeStopper(object):
             return False
 
 def f(x):
-    plant.layout = x.reshape((5, 2))
+    plant.layout = x.reshape((-1, 2))
     plant.set_layout()
     return -utils.get_energy(plant)
 
+def f_population(xs):
+    ''' Vectorized objective, xs of shape (2n, S) is a population of S
+    layouts, see optimize.differential_evolution(..., vectorized=True). '''
+    layouts = xs.T.reshape((xs.shape[1], -1, 2))
+    return -utils.get_energies(plant, layouts)
+
 if __name__ == "__main__":
     ## Tiny plant, n=5 heliostats
     plant = Plant()
@@ -48,7 +54,8 @@ if __name__ == "__main__":
 
     ## optimize
     result = optimize.differential_evolution(
-        f, bounds,
+        f_population, bounds,
+        vectorized=True, updating='deferred',
         # x0=x0,
         maxiter=150,
         # callback=MinimizeStopper(1E-3)
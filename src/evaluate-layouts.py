@@ -1,29 +1,75 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-""" evaluate-layouts.py - evaluates layouts for Tiny plant. """
+""" evaluate-layouts.py - evaluates layouts for Tiny plant.
+
+    Usage:
+        evaluate-layouts.py [library]
+    with a library the layouts of the library are evaluated in blocks on
+    their plants in ../data/plants and their energies are stored in it, see
+    library.py. """
 
 import os
+import sys
 import numpy as np
 import pandas as pd
 from plant import Plant
 import utils
+from library import LayoutLibrary
+from store import ResultStore
+
+def get_plants(directory="../data/plants/"):
+    ''' Returns the plant specs in the directory by the names of the
+    plants. '''
+    plants = {}
+    for file in sorted(os.listdir(directory)):
+        plant_d = utils.load(os.path.join(directory, file))
+        plants[plant_d["name"]] = plant_d
+    return plants
+
+def evaluate_library(path, plants, block=10000):
+    ''' Evaluates the layouts of the library not evaluated yet, each on the
+    plant of its record from plants, the plant specs by their names, see
+    get_plants, and prints the best ones. '''
+    library = LayoutLibrary(path, "a")
+    for start, layouts in library.iter_blocks(block):
+        indices = np.arange(start, start + len(layouts))
+        todo = np.isnan(library.energies[indices])
+        for plant in np.unique(library.index["plant"][indices[todo]]):
+            name = library.meta["plants"][plant]
+            if name not in plants:
+                raise ValueError("no specs of plant {} of library {}".format(
+                    name, path))
+            ks = np.flatnonzero(todo & (library.index["plant"][indices] == plant))
+            energies, valid = utils.evaluate_many([layouts[k] for k in ks],
+                plants[name], skip_invalid=True, store=ResultStore())
+            ## invalid layouts are marked with -inf
+            library.set_energies(indices[ks], np.where(valid, energies, -np.inf))
+    print(library)
+    for k in np.argsort(-np.nan_to_num(library.energies, nan=-np.inf, neginf=-np.inf))[:10]:
+        print("{:24s} {:10.2f}".format(library.get_name(k), library.energies[k]))
 
 if __name__ == "__main__":
     ## Plant=Tiny, n=5 heliostats
     plant = Plant()
+    if len(sys.argv) > 1:
+        evaluate_library(sys.argv[1], get_plants())
+        sys.exit()
+
+    ## evaluate layouts in parallel
+    files = os.listdir("../data/layouts/")
+    layouts = [utils.load("../data/layouts/"+layout) for layout in files]
+    plant_d = utils.load("../data/plants/tiny-plant.json")
+    energies, valid = utils.evaluate_many(layouts, plant_d, skip_invalid=True,
+                                          store=ResultStore())
 
-    ## evaluate layouts
     d = {}
-    for layout in os.listdir("../data/layouts/"):
-        plant = Plant(utils.load("../data/layouts/"+layout))
-        energy = utils.get_energy(plant, do_stats=False)
-        valid = plant.check_layout()
-        name = layout.split(".")[0]
-        if not valid:
+    for layout, file, energy, valid_layout in zip(layouts, files, energies, valid):
+        name = file.split(".")[0]
+        if not valid_layout:
             print(name + ' is not valid')
         else:
             d[name] = np.round(energy, 2)
-            plant.draw(name=name)
+            Plant(layout).draw(name=name)
     d
     df = pd.DataFrame.from_dict(d, orient='index', columns=['Energy'])
     df = df.sort_values(by=['Energy'], ascending=False)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" evaluator.py - incremental evaluation of the energy when a single
+    heliostat moves, for coordinate-wise optimization and gradients. """
+
+import numpy as np
+import geometry
+import batch
+from sun import Sun
+
+class Evaluator:
+    ''' Evaluates the energy of a plant and caches the geometry, the numbers
+    of heliostats that shade or block each ray and the effects of each
+    heliostat in each sun angle. Moving heliostat i with move(i, xy) then
+    only updates the rays of heliostat i and the rays of other heliostats
+    that hit the old or the new position of heliostat i, that is O(n) work
+    instead of O(n^2) of utils.get_energy. The energy is the same as
+    utils.get_energy(plant) of the moved plant.
+
+    For example:
+        evaluator = Evaluator(plant)
+        evaluator.move(2, [21, 4])
+        evaluator.energy()
+    '''
+    def __init__(self, plant, sun=None):
+        self.plant = plant
+        if sun is None:
+            sun = Sun(180)
+        self.sun = sun
+        if not np.issubdtype(self.plant.layout.dtype, np.floating):
+            self.plant.layout = self.plant.layout.astype(float)
+        self.reset()
+
+    def reset(self):
+        ''' Evaluates all the heliostats in all sun angles from scratch. '''
+        plant = self.plant
+        self.max_ij = plant.max_ij
+        self.heli_suns, self.heli_normals, self.heli_as, self.heli_bs, \
+            self.surf_points, self.ref_ends, self.sun_ends = \
+            batch.get_geometry(plant, self.sun.angles)
+
+        ## the numbers of heliostats hit by sun rays and reflected rays
+        own = np.arange(plant.n)
+        self.shaded = geometry.get_hit_rays(self.heli_as, self.heli_bs,
+            self.surf_points, self.sun_ends, own, counts=True)
+        self.blocked = geometry.get_hit_rays(self.heli_as, self.heli_bs,
+            self.surf_points, self.ref_ends, own, counts=True)
+        self.not_missed = geometry.intersect(plant.rec_a, plant.rec_b,
+            self.surf_points, self.ref_ends)
+        self.set_powers()
+
+    def move(self, i, xy):
+        ''' Moves heliostat i to position xy and updates the cache. If the
+        move changes max_ij, the length of all sun rays, the cache is reset.
+        '''
+        plant = self.plant
+        old_as, old_bs = self.heli_as[:, i].copy(), self.heli_bs[:, i].copy()
+        plant.layout[i] = xy
+        plant.set_layout()
+        if plant.max_ij != self.max_ij:
+            self.reset()
+            return
+
+        ## geometry of heliostat i
+        heliostat = slice(i, i + 1)
+        self.heli_suns[:, heliostat], self.heli_normals[:, heliostat], \
+            self.heli_as[:, heliostat], self.heli_bs[:, heliostat], \
+            self.surf_points[:, heliostat], self.ref_ends[:, heliostat], \
+            self.sun_ends[:, heliostat] = \
+            batch.get_geometry(plant, self.sun.angles, heliostat)
+
+        ## rays of other heliostats that hit the old or the new heliostat i
+        for counts, ends in [(self.shaded, self.sun_ends),
+                             (self.blocked, self.ref_ends)]:
+            counts -= geometry.get_hit_rays(old_as[:, None], old_bs[:, None],
+                self.surf_points, ends, counts=True)
+            counts += geometry.get_hit_rays(self.heli_as[:, heliostat],
+                self.heli_bs[:, heliostat], self.surf_points, ends, counts=True)
+
+            ## rays of heliostat i
+            counts[:, i] = geometry.get_hit_rays(self.heli_as, self.heli_bs,
+                self.surf_points[:, heliostat], ends[:, heliostat],
+                own=np.array([i]), counts=True)[:, 0]
+
+        self.not_missed[:, i] = geometry.intersect(plant.rec_a, plant.rec_b,
+            self.surf_points[:, i], self.ref_ends[:, i])
+        self.set_powers()
+
+    def set_powers(self):
+        ''' Sets the effects and the powers in each sun angle. '''
+        received = np.sum((self.shaded == 0) & (self.blocked == 0) & \
+                          self.not_missed, axis=2)
+        self.eta_sbm = received / self.plant.heli_rays
+        self.eta_aa, self.eta_cos = batch.get_effects(
+            self.plant, self.heli_suns, self.heli_normals)
+        self.powers = batch.sum_powers(
+            self.eta_aa, self.eta_cos, self.eta_sbm).astype(float)
+
+    def energy(self):
+        ''' Returns the energy of the plant with the current layout. '''
+        return np.sum(self.sun.weights * self.powers)
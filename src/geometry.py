@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" geometry.py - vectorized geometric kernels used by the energy model. """
+
+import numpy as np
+import profiling
+
+## upper bound on the number of segment pairs tested in one kernel call,
+## larger problems are split into chunks to keep the memory bounded
+MAX_PAIRS = 2**20
+
+## part of the heliostat surface covered by the rays, as fractions of its
+## size from the edge point b towards the edge point a
+SURF_SPAN = (0.1, 0.9)
+
+def intersect(a, b, c, d):
+    ''' Checks if line segments ab intersect line segments cd.
+
+    Vectorized version of State.intersect, the inputs are arrays of points
+    with the coordinates in the last axis and are broadcast against each
+    other, e.g. a, b of shape (1, 1, n, 2) and c, d of shape (n, rays, 1, 2)
+    return a boolean array of shape (n, rays, n).
+    '''
+    x1, y1 = a[..., 0], a[..., 1]
+    x2, y2 = b[..., 0], b[..., 1]
+    x3, y3 = c[..., 0], c[..., 1]
+    x4, y4 = d[..., 0], d[..., 1]
+
+    denom = (y4 - y3)*(x2 - x1) - (x4 - x3)*(y2 - y1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ua = ((x4 - x3)*(y1 - y3) - (y4 - y3)*(x1 - x3)) / denom
+        ub = ((x2 - x1)*(y1 - y3) - (y2 - y1)*(x1 - x3)) / denom
+
+    # parallel segments have denom == 0 and are never intersecting
+    return (denom != 0) & (ua >= 0) & (ua <= 1) & (ub >= 0) & (ub <= 1)
+
+def get_mirrors(layout, heli_refs, sun_angles, heli_size):
+    ''' Returns the heliostats sun vectors, normals, tangent vectors and edge
+    points, the same as the attributes of State. For a layout of shape
+    (n, 2) and sun_angles of shape (m,) the arrays have shape (m, n, 2), for
+    a single sun angle they have shape (n, 2).
+    '''
+    sun_vecs = np.stack((np.cos(sun_angles), np.sin(sun_angles)), axis=-1)
+    heli_suns = layout + sun_vecs[..., None, :]
+
+    ## heliostats normals
+    heli_normals = heli_refs + heli_suns - 2 * layout
+    normal_lengths = np.linalg.norm(heli_normals, axis=-1)
+    heli_normals = layout + heli_normals / normal_lengths[..., None]
+
+    ## heliostats tangent vectors and edge points
+    heli_tans = heli_normals - layout
+    heli_tans = np.stack((-heli_tans[..., 1], heli_tans[..., 0]), axis=-1)
+    heli_as = layout + heli_size / 2 * heli_tans
+    heli_bs = layout - heli_size / 2 * heli_tans
+
+    return heli_suns, heli_normals, heli_tans, heli_as, heli_bs
+
+def get_ray_points(heli_bs, heli_tans, heli_size, heli_rays,
+                   ref_vecs, ref_lengths, sun_vecs, sun_length, d_factor):
+    ''' Returns the points on the rays of shape (..., n, heli_rays, 2):
+        * surface points on the heliostats
+        * reflected rays ends towards the receiver
+        * sun rays ends towards the sun
+    where heli_bs, heli_tans, ref_vecs, sun_vecs are of shape (..., n, 2),
+    ref_lengths are the lengths of the reflected rays of shape (..., n),
+    sun_length is the length of the sun rays and both are multiplied by
+    d_factor.
+    '''
+    surf_coefs = np.linspace(SURF_SPAN[0], SURF_SPAN[1], heli_rays)[:, None]
+    surf_points = heli_bs[..., None, :] + \
+        surf_coefs * heli_tans[..., None, :] * heli_size
+
+    ref_ends = surf_points + \
+        (ref_vecs * ref_lengths[..., None] * d_factor)[..., None, :]
+    sun_ends = surf_points + (sun_vecs * sun_length * d_factor)[..., None, :]
+
+    return surf_points, ref_ends, sun_ends
+
+def get_hit_rays(seg_as, seg_bs, starts, ends, own=None, counts=False):
+    ''' Returns a boolean array of shape (..., n, rays) of rays that hit any
+    of the segments, or the number of segments hit by each ray if counts,
+    where:
+        * seg_as, seg_bs of shape (..., k, 2) are the edge points of segments
+        * starts, ends of shape (..., n, rays, 2) are rays start and end points
+        * own of shape (n,) are indices of segments the rays of i start from,
+        these are skipped, e.g. np.arange(n) for rays of the heliostats
+    the leading dimensions, e.g. sun angles, are broadcast.
+    '''
+    batch_shape = np.broadcast_shapes(seg_as.shape[:-2], starts.shape[:-3])
+    n, rays, k = starts.shape[-3], starts.shape[-2], seg_as.shape[-2]
+    seg_as = np.broadcast_to(seg_as, batch_shape + (k, 2)).reshape(-1, k, 2)
+    seg_bs = np.broadcast_to(seg_bs, batch_shape + (k, 2)).reshape(-1, k, 2)
+    starts = np.broadcast_to(starts, batch_shape + (n, rays, 2)).reshape(-1, n, rays, 2)
+    ends = np.broadcast_to(ends, batch_shape + (n, rays, 2)).reshape(-1, n, rays, 2)
+
+    n_batch = starts.shape[0]
+    hit = np.zeros((n_batch, n, rays), dtype=int if counts else bool)
+    if n_batch == 0 or n == 0 or k == 0:
+        return hit.reshape(batch_shape + (n, rays))
+
+    ## chunks of (batch, heliostat) rows with at most MAX_PAIRS tests
+    rows = max(1, MAX_PAIRS // (rays * k))
+    i_chunk = min(n, rows)
+    b_chunk = max(1, rows // n)
+    for b0 in range(0, n_batch, b_chunk):
+        b1 = min(n_batch, b0 + b_chunk)
+        seg_a = seg_as[b0:b1, None, None, :, :]
+        seg_b = seg_bs[b0:b1, None, None, :, :]
+        for i0 in range(0, n, i_chunk):
+            i1 = min(n, i0 + i_chunk)
+            hits = intersect(seg_a, seg_b,
+                             starts[b0:b1, i0:i1, :, None, :],
+                             ends[b0:b1, i0:i1, :, None, :])
+            profiling.count("intersection_tests", hits.size)
+            if own is not None:
+                hits[:, np.arange(i1 - i0), :, own[i0:i1]] = False
+            if counts:
+                hit[b0:b1, i0:i1] = np.sum(hits, axis=3)
+            else:
+                hit[b0:b1, i0:i1] = np.any(hits, axis=3)
+    return hit.reshape(batch_shape + (n, rays))
+
+def cross(u, v):
+    ''' Returns the cross products of 2D vectors in the last axis. '''
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+def get_hit_intervals(origins, us, vs, lengths, seg_as, seg_bs, own=None):
+    ''' For rays starting at points origins + s * us and going in directions
+    vs up to lengths, returns the intervals [starts, ends] of s for which
+    the rays hit the segments ab, where:
+        * origins, us, vs of shape (..., n, 2), lengths of shape (..., n)
+        * seg_as, seg_bs of shape (..., k, 2)
+        * own are skipped segments as in get_hit_rays
+    The intervals are of shape (..., n, k) and empty ones have starts = ends.
+    '''
+    ## edge points of the segments in coordinates (s, t) of the rays, where
+    ## point = origin + s * u + t * v
+    det = cross(us, vs)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ss, ts = [], []
+        for points in [seg_as, seg_bs]:
+            ds = points[..., None, :, :] - origins[..., :, None, :]
+            ss.append(cross(ds, vs[..., None, :]) / det)
+            ts.append(cross(us[..., None, :], ds) / det)
+        (s_a, s_b), (t_a, t_b) = ss, ts
+
+        ## the part of the segments with 0 <= t <= length
+        lengths = lengths[..., None]
+        dt = t_b - t_a
+        l_0, l_t = -t_a / dt, (lengths - t_a) / dt
+        lambda_lo = np.where(dt == 0, 0, np.maximum(np.minimum(l_0, l_t), 0))
+        lambda_hi = np.where(dt == 0, 1, np.minimum(np.maximum(l_0, l_t), 1))
+        flat_in = (t_a >= 0) & (t_a <= lengths)
+        hit = (det != 0) & (lambda_lo <= lambda_hi) & ((dt != 0) | flat_in)
+
+        ## projections of the parts to s
+        s_lo = s_a + lambda_lo * (s_b - s_a)
+        s_hi = s_a + lambda_hi * (s_b - s_a)
+    starts = np.where(hit, np.minimum(s_lo, s_hi), 0)
+    ends = np.where(hit, np.maximum(s_lo, s_hi), 0)
+    if own is not None:
+        own_mask = np.arange(seg_as.shape[-2]) == own[:, None]
+        starts = np.where(own_mask, 0, starts)
+        ends = np.where(own_mask, 0, ends)
+    return starts, ends
+
+def get_union_length(starts, ends, lo, hi):
+    ''' Returns the lengths of unions of the intervals [starts, ends] clipped
+    to [lo, hi] along the last axis, by sorting and sweeping. '''
+    starts = np.clip(starts, lo[..., None], hi[..., None])
+    ends = np.maximum(np.clip(ends, lo[..., None], hi[..., None]), starts)
+    order = np.argsort(starts, axis=-1)
+    starts = np.take_along_axis(starts, order, axis=-1)
+    ends = np.take_along_axis(ends, order, axis=-1)
+
+    ## each interval adds the part after the furthest end of previous ones
+    reach = np.maximum.accumulate(ends, axis=-1)
+    reach = np.concatenate((np.broadcast_to(lo[..., None], reach[..., :1].shape),
+                            reach[..., :-1]), axis=-1)
+    return np.sum(np.maximum(ends - np.maximum(starts, reach), 0), axis=-1)
+
+## relative and absolute margins of the interaction windows, so that the
+## rounding errors never exclude a pair that intersects
+WINDOW_MARGIN = 1e-9
+
+def get_reach(heli_size):
+    ''' Returns the largest distance between the centers of two heliostats
+    at which a ray from one can hit the other, when it is parallel to them,
+    with a margin. The rays start within heli_size / 2 of the center. '''
+    return heli_size * (1 + WINDOW_MARGIN) + WINDOW_MARGIN
+
+def get_shading_windows(layout, heli_size, pairs_i, pairs_k):
+    ''' Returns the windows of the sun angles in which heliostat k can shade
+    heliostat i for the candidate pairs (pairs_i, pairs_k) of shape (p,), as
+    the centers and the half widths of shape (p,): the sun rays of i can hit
+    k only if the angle of the sun is within half_widths[p] of centers[p].
+    The half width is pi for all angles.
+
+    The sun rays of i pass within heli_size / 2 of the center of k only if
+    the distance from d = layout[k] - layout[i] to the ray through the
+    center of i, in the direction s of the sun, is at most
+    get_reach(heli_size). For |d| above the reach this holds only for s
+    within arcsin(reach / |d|) of the direction of d. The candidates should
+    be the pairs closer than the length of the sun rays plus the reach, see
+    Plant.get_windows.
+    '''
+    layout = np.asarray(layout, dtype=float)
+    reach = get_reach(heli_size)
+    ds = layout[pairs_k] - layout[pairs_i]
+    dists = np.sqrt(np.sum(ds**2, axis=-1))
+    centers = np.arctan2(ds[:, 1], ds[:, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_widths = np.arcsin(np.minimum(reach / dists, 1)) + WINDOW_MARGIN
+    half_widths = np.where(dists <= reach, np.pi, half_widths)
+    return centers, half_widths
+
+def get_active_pairs(centers, half_widths, sun_angles):
+    ''' Returns the active pairs of the windows of shape (p,), see
+    get_shading_windows, in each of the sun angles of shape (m,) as the
+    indices (ts, ps) of the sun angles and the windows.
+
+    The windows of less than pi are grouped by the half widths in levels
+    (pi / 2**(l + 1), pi / 2**l] and sorted by the centers in each level, so
+    only the windows with the centers within the largest half width of the
+    level from a sun angle are tested, in chunks of at most MAX_PAIRS.
+    '''
+    sun_angles = np.asarray(sun_angles, dtype=float)
+    m = len(sun_angles)
+    if m == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    always = np.flatnonzero(half_widths >= np.pi)
+    ts, ps = [np.repeat(np.arange(m), len(always))], [np.tile(always, m)]
+
+    ## sun angles in [-pi, pi) and the centers shifted by 2 pi both ways, so
+    ## the ranges of the centers do not wrap around
+    wrapped = (sun_angles + np.pi) % (2 * np.pi) - np.pi
+    rest = np.flatnonzero((half_widths >= 0) & (half_widths < np.pi))
+    levels = np.floor(np.log2(np.pi / half_widths[rest])).astype(int)
+    for level in np.unique(levels):
+        group = rest[levels == level]
+        group = group[np.argsort(centers[group])]
+        shifted = np.concatenate((centers[group] - 2 * np.pi, centers[group],
+                                  centers[group] + 2 * np.pi))
+        width = np.max(half_widths[group]) + WINDOW_MARGIN
+        los = np.searchsorted(shifted, wrapped - width, side="left")
+        counts = np.searchsorted(shifted, wrapped + width, side="right") - los
+
+        ## chunks of the sun angles with at most MAX_PAIRS candidates
+        totals = np.cumsum(counts)
+        bounds = np.searchsorted(totals, np.arange(MAX_PAIRS, totals[-1], MAX_PAIRS))
+        for t0, t1 in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [m]))):
+            t = np.repeat(np.arange(t0, t1), counts[t0:t1])
+            offsets = np.arange(len(t)) - np.repeat(
+                np.cumsum(counts[t0:t1]) - counts[t0:t1], counts[t0:t1])
+            p = group[(los[t] + offsets) % len(group)]
+            gaps = np.abs((sun_angles[t] - centers[p] + np.pi) % (2 * np.pi) - np.pi)
+            active = gaps <= half_widths[p]
+            ts.append(t[active])
+            ps.append(p[active])
+    return np.concatenate(ts), np.concatenate(ps)
+
+def get_blocking_pairs(layout, heli_size, ref_vecs, ref_lengths, pairs=None):
+    ''' Returns the pairs (pairs_i, pairs_k) for which the reflected rays
+    of heliostat i, in the directions ref_vecs of shape (n, 2) with lengths
+    ref_lengths of shape (n,), can hit heliostat k, the same for all sun
+    angles. As in get_shading_windows the distance from d to the reflected
+    ray of the center of i must be at most get_reach(heli_size). Only the
+    candidate pairs are tested, by default found with a SegmentGrid over
+    the squares around the centers, so the memory is linear in the number
+    of the candidates. '''
+    layout = np.asarray(layout, dtype=float)
+    ref_vecs = np.asarray(ref_vecs, dtype=float)
+    ref_lengths = np.asarray(ref_lengths, dtype=float)
+    n = len(layout)
+    if n < 2:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    reach = get_reach(heli_size)
+    if pairs is None:
+        grid = SegmentGrid(layout - reach, layout + reach)
+        ends = layout + ref_vecs * ref_lengths[:, None]
+        pairs = grid.query(layout[:, None], ends[:, None], own=np.arange(n))
+    pairs_i, pairs_k = pairs
+
+    ds = layout[pairs_k] - layout[pairs_i]
+    ts = np.clip(np.sum(ds * ref_vecs[pairs_i], axis=-1), 0, ref_lengths[pairs_i])
+    dists = np.sqrt(np.sum((ds - ts[:, None] * ref_vecs[pairs_i])**2, axis=-1))
+    close = dists <= reach
+    return pairs_i[close], pairs_k[close]
+
+def get_hit_rays_pairs(seg_as, seg_bs, starts, ends, pairs_i, pairs_k):
+    ''' Returns a boolean array of shape (n, rays) of rays that hit any of
+    the segments, like get_hit_rays, but only rays of heliostat pairs_i[p]
+    are tested against segment pairs_k[p], for candidate pairs p. '''
+    n, rays = starts.shape[0], starts.shape[1]
+    hit = np.zeros((n, rays), dtype=bool)
+    chunk = max(1, MAX_PAIRS // max(1, rays))
+    for p0 in range(0, len(pairs_i), chunk):
+        i, k = pairs_i[p0:p0 + chunk], pairs_k[p0:p0 + chunk]
+        hits = intersect(seg_as[k, None, :], seg_bs[k, None, :], starts[i], ends[i])
+        profiling.count("intersection_tests", hits.size)
+        np.logical_or.at(hit, i, hits)
+    return hit
+
+class SegmentGrid:
+    ''' Uniform grid over line segments used to cull the candidates of the
+    intersection tests. Each segment is registered in all cells overlapped by
+    its bounding box, the cell size defaults to the longest segment.
+    '''
+    def __init__(self, seg_as, seg_bs, cell_size=None):
+        seg_as = np.asarray(seg_as, dtype=float)
+        seg_bs = np.asarray(seg_bs, dtype=float)
+        self.n_segs = len(seg_as)
+        lows = np.minimum(seg_as, seg_bs)
+        highs = np.maximum(seg_as, seg_bs)
+
+        ## padding of the bounding boxes against rounding errors
+        self.pad = 1e-9 * (1 + np.max(np.abs(np.concatenate((lows, highs)))))
+        lows, highs = lows - self.pad, highs + self.pad
+
+        if cell_size is None:
+            cell_size = np.max(highs - lows)
+        self.cell_size = cell_size
+        self.origin = np.min(lows, axis=0)
+        self.shape = (np.floor((np.max(highs, axis=0) - self.origin) \
+            / self.cell_size)).astype(int) + 1
+
+        ## segments in each cell as compressed rows: the segments in cell c
+        ## are self.segs[self.starts[c]:self.starts[c + 1]]
+        seg_ids, cells = self.get_cells(lows, highs)
+        order = np.argsort(cells, kind="stable")
+        self.segs = seg_ids[order]
+        counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+
+    def get_cells(self, lows, highs):
+        ''' Returns pairs (box index, cell index) of cells overlapped by the
+        bounding boxes given by the lower left and upper right corners. '''
+        lo = np.floor((lows - self.origin) / self.cell_size).astype(int)
+        hi = np.floor((highs - self.origin) / self.cell_size).astype(int)
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, self.shape - 1)
+        widths = np.maximum(hi - lo + 1, 0)
+        counts = widths[:, 0] * widths[:, 1]
+
+        ## expand boxes into the cells they overlap
+        box_ids = np.repeat(np.arange(len(lows)), counts)
+        offsets = np.arange(np.sum(counts)) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        xs = lo[box_ids, 0] + offsets % widths[box_ids, 0]
+        ys = lo[box_ids, 1] + offsets // widths[box_ids, 0]
+        return box_ids, xs * self.shape[1] + ys
+
+    def query(self, starts, ends, own=None, chunk=256):
+        ''' Returns candidate pairs (pairs_i, pairs_k) of heliostats i and
+        segments k that the bounding corridor of the rays of heliostat i can
+        touch, where starts, ends of shape (n, rays, 2) are parallel rays
+        starting on the heliostats and own are the skipped segments as in
+        get_hit_rays. The pairs are sorted by i. '''
+        n = starts.shape[0]
+        pairs_i, pairs_k = [], []
+        for i0 in range(0, n, chunk):
+            i1 = min(n, i0 + chunk)
+            pi, pk = self.query_chunk(starts[i0:i1], ends[i0:i1])
+            pi += i0
+            if own is not None:
+                others = pk != own[pi]
+                pi, pk = pi[others], pk[others]
+            pairs_i.append(pi)
+            pairs_k.append(pk)
+        if n == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(pairs_i), np.concatenate(pairs_k)
+
+    def query_chunk(self, starts, ends):
+        ## corridor of the rays is the parallelogram between the first and the
+        ## last ray, split into pieces along the rays no longer than a cell
+        s0, s1 = starts[:, 0].astype(float), starts[:, -1].astype(float)
+        e0, e1 = ends[:, 0].astype(float), ends[:, -1].astype(float)
+        lengths = np.linalg.norm(e0 - s0, axis=1)
+        n_pieces = np.maximum(np.ceil(lengths / self.cell_size), 1).astype(int)
+
+        heli_ids = np.repeat(np.arange(len(starts)), n_pieces)
+        js = np.arange(np.sum(n_pieces)) - \
+            np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        t0 = (js / n_pieces[heli_ids])[:, None]
+        t1 = ((js + 1) / n_pieces[heli_ids])[:, None]
+        ws0, ws1 = e0[heli_ids] - s0[heli_ids], e1[heli_ids] - s1[heli_ids]
+        corners = np.stack((s0[heli_ids] + t0 * ws0, s0[heli_ids] + t1 * ws0,
+                            s1[heli_ids] + t0 * ws1, s1[heli_ids] + t1 * ws1))
+        lows = np.min(corners, axis=0) - self.pad
+        highs = np.max(corners, axis=0) + self.pad
+
+        ## cells of the pieces and segments in these cells
+        piece_ids, cells = self.get_cells(lows, highs)
+        counts = self.starts[cells + 1] - self.starts[cells]
+        heli_ids = np.repeat(heli_ids[piece_ids], counts)
+        offsets = np.arange(np.sum(counts)) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        seg_ids = self.segs[np.repeat(self.starts[cells], counts) + offsets]
+
+        ## unique pairs sorted by heliostat
+        keys = np.unique(heli_ids * self.n_segs + seg_ids)
+        return keys // self.n_segs, keys % self.n_segs
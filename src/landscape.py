@@ -3,13 +3,20 @@
 """ landscape.py - starting from some basic layout, try to optimize
     on position of a single heliostat to be able to draw some figures. """
 
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from plant import Plant
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from mpl_toolkits.mplot3d import Axes3D
+from evaluator import Evaluator
+from store import ResultStore
 import utils
 
+## optional result store of the energies of f, see store.ResultStore
+store = None
+
 def get_points(xs, ys, zs):
     # to be able to add constraints
     grid_points = []
@@ -41,6 +48,11 @@ def surface_plot(points):
     ax.set_ylabel('y-position')
     ax.set_zlabel('Energy')
 
+    ## points not evaluated yet are nan, see load_grid
+    done = np.isfinite(zpts)
+    xpts, ypts = np.array(xpts)[done], np.array(ypts)[done]
+    zpts = np.array(zpts)[done]
+
     surf = ax.plot_trisurf(xpts, ypts, zpts, cmap=cm.jet, linewidth=0, alpha=.6)
     fig.colorbar(surf)
 
@@ -55,43 +67,156 @@ def surface_plot(points):
 def contour_plot(XYZ):
     fig, ax = plt.subplots(1, 1, figsize=(20, 10))
     X, Y, Z = XYZ
-    ax.contour(X, Y, Z, 25)
+    ax.contour(X, Y, np.ma.masked_invalid(Z), 25)
     plt.show()
 
-def grad(plant, x):
-    ''' Estimates the gradient.
-        TODO: could try central difference and different step size h. '''
-    h = 0.1
+def grad(evaluator, x, i=2, h=0.1):
+    ''' Estimates the gradient of f with respect to the ith heliostat
+    position by central differences with step h, so only heliostat i is
+    moved and the energy is the one of the plots. The energy is piecewise
+    constant in the position, so the step is not too small. '''
     e1 = np.array([1, 0])
     e2 = np.array([0, 1])
-    return np.array([(f(plant, x + h*e1) - f(plant, x))/h,
-                     (f(plant, x + h*e2) - f(plant, x))/h])
+    return np.array([(f(evaluator, x + h*e1, i) - f(evaluator, x - h*e1, i))/(2*h),
+                     (f(evaluator, x + h*e2, i) - f(evaluator, x - h*e2, i))/(2*h)])
+
+def f(evaluator, x, i=2):
+    ''' Returns plants energy as a function of ith heliostat position,
+    only heliostat i is re-evaluated, see evaluator.Evaluator. With a store
+    the energy is simulated only if it is not stored. '''
+    if store is None:
+        evaluator.move(i, [x[0], x[1]])
+        return evaluator.energy()
+
+    layout = np.array(evaluator.plant.layout, dtype=float)
+    layout[i] = x
+    ## the energy of the evaluator is the one of utils.get_energy
+    key = store.get_key(evaluator.plant, layout, evaluator.sun)
+    energy = store.get(key)
+    if energy is None:
+        evaluator.move(i, [x[0], x[1]])
+        energy = evaluator.energy()
+        store.put(key, evaluator.plant.name, evaluator.plant.n, energy)
+    return energy
+
+## evaluator of the worker process, see evaluate_grid
+worker_evaluator = None
+
+def init_worker(plant, worker_store=None):
+    global worker_evaluator, store
+    worker_evaluator = Evaluator(plant)
+    store = worker_store
+
+def evaluate_points(f, points):
+    return [f(worker_evaluator, point) for point in points]
+
+def get_done_name(file_name):
+    ''' Returns the file name of the completion bitmap of file_name. '''
+    return file_name[:-len(".npy")] + ".done.npy"
+
+def get_grid_name(file_name):
+    ''' Returns the file name of the xs and ys of the grid of file_name. '''
+    return file_name[:-len(".npy")] + ".grid.npz"
 
-def f(plant, x, i=2):
-    ''' Returns plants energy as a function of ith heliostat position.'''
-    plant.layout[i] = [x[0], x[1]]
-    plant.set_layout()
-    return utils.get_energy(plant)
+def is_same_grid(xs, ys, file_name):
+    ''' Checks if the values in file_name are of the grid of xs and ys. '''
+    if not os.path.exists(get_grid_name(file_name)):
+        return False
+    with np.load(get_grid_name(file_name)) as grid:
+        return np.array_equal(grid["xs"], xs) and np.array_equal(grid["ys"], ys)
 
-def evaluate_grid(xs, ys, f, plant, recompute=False):
+def load_grid(file_name="../data/results/zs.npy"):
+    ''' Returns the values of the grid in file_name, also while
+    evaluate_grid is running, the points not evaluated yet are nan. '''
+    zs = np.array(np.load(file_name, mmap_mode="r"))
+    if os.path.exists(get_done_name(file_name)):
+        done = np.load(get_done_name(file_name), mmap_mode="r")
+        zs[~done] = np.nan
+    return zs
+
+def evaluate_grid(xs, ys, f, evaluator, recompute=False,
+                  file_name="../data/results/zs.npy", workers=1):
+    ''' Returns f(evaluator, [x, y]) on the grid of xs and ys as an array of
+    nx * ny values, for x in xs and y in ys.
+
+    The values are written to file_name as they are computed, along with a
+    bitmap of the evaluated points and the xs and ys of the grid, so an
+    interrupted run on the same grid continues where it stopped, unless
+    recompute. The values of another grid are not overwritten unless
+    recompute, a file_name without its grid is taken as a complete run. The rows of the grid are evaluated in worker processes, each
+    with its own copy of the evaluator, or in this process if workers=1. '''
     nx, ny = len(xs), len(ys)
-    if recompute:
-        zs = []
-        for i in range(nx):
-            for j in range(ny):
-                zs.append( f(plant, [xs[i], ys[j]]) )
-        with open("../data/results/zs.npy", "wb") as f:
-            np.save(f, zs)
+    done_name = get_done_name(file_name)
+    grid_name = get_grid_name(file_name)
+    if recompute or not os.path.exists(file_name):
+        same = False
+    elif os.path.exists(grid_name):
+        if not is_same_grid(xs, ys, file_name):
+            raise ValueError("{} holds the values of another grid, use recompute "
+                             "to overwrite them".format(file_name))
+        same = True
+    elif not os.path.exists(done_name):
+        ## results of a complete run saved without their grid
+        zs = np.load(file_name)
+        if zs.shape != (nx * ny,):
+            raise ValueError("{} holds {} values, not the {} of the grid, use "
+                             "recompute to overwrite them".format(
+                                 file_name, zs.size, nx * ny))
+        np.savez(grid_name, xs=xs, ys=ys)
+        return zs
+    else:
+        ## start interrupted before its grid was saved
+        same = False
+    if same and not os.path.exists(done_name):
+        ## results of a complete run
+        return np.load(file_name)
+
+    if not same:
+        ## the grid is saved last, so an interrupted start is not resumed
+        if os.path.exists(grid_name):
+            os.remove(grid_name)
+        done = np.lib.format.open_memmap(done_name, mode="w+",
+                                         dtype=bool, shape=(nx * ny,))
+        zs = np.lib.format.open_memmap(file_name, mode="w+",
+                                       dtype=float, shape=(nx * ny,))
+        zs[:] = np.nan
+        np.savez(grid_name, xs=xs, ys=ys)
     else:
-        with open("../data/results/zs.npy", "rb") as f:
-            zs = np.load(f)
+        zs = np.lib.format.open_memmap(file_name, mode="r+")
+        done = np.lib.format.open_memmap(done_name, mode="r+")
+
+    ## rows of the grid that are not complete
+    rows = [i for i in range(nx) if not np.all(done[i * ny:(i + 1) * ny])]
+    points = {i: [[xs[i], ys[j]] for j in range(ny)] for i in rows}
+
+    def save_row(i, row_zs):
+        ## values are flushed before the bitmap claims them
+        zs[i * ny:(i + 1) * ny] = row_zs
+        zs.flush()
+        done[i * ny:(i + 1) * ny] = True
+        done.flush()
+
+    if workers == 1:
+        for i in rows:
+            save_row(i, [f(evaluator, point) for point in points[i]])
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(evaluator.plant, store)) as executor:
+            futures = {executor.submit(evaluate_points, f, points[i]): i
+                       for i in rows}
+            for future in as_completed(futures):
+                save_row(futures[future], future.result())
+
+    zs = np.array(zs)
+    del done
+    os.remove(done_name)
     return zs
 
-def gradient_ascent(plant, x, grad, sigma, max_iter=10):
+def gradient_ascent(evaluator, x, grad, sigma, max_iter=10):
     xs = np.zeros((1 + max_iter, x.shape[0]))
     xs[0] = x
     for i in range(max_iter):
-        g = grad(plant, x)
+        g = grad(evaluator, x)
         norm_g = np.linalg.norm(g)
         if norm_g > 0:
             g = g / norm_g
@@ -127,6 +252,8 @@ if __name__ == "__main__":
     ## Tiny plant, n=5 heliostats, pick parabolic-layout
     n = 5
     plant = Plant(utils.load("../data/layouts/parabolic-layout.json"))
+    evaluator = Evaluator(plant)
+    store = ResultStore()
     ## check result:
     # print(plant.valid_layout)
     # print(utils.get_energy(plant))
@@ -135,7 +262,7 @@ if __name__ == "__main__":
     ## optimize on only the middle heliostat position
     ## so we can draw the figures
     ## so we have a function of two variables x1, x2
-    # f(plant, [21, 4]) # = 63.13903716835735
+    # f(evaluator, [21, 4]) # = 63.13903716835735
 
     ## evaluate f on a grid
     nx = 70
@@ -143,7 +270,8 @@ if __name__ == "__main__":
     print(nx, ny)
     xs = np.linspace(plant.x_min, plant.x_max, nx)
     ys = np.linspace(plant.y_min, plant.y_max, ny)
-    zs = evaluate_grid(xs, ys, f, plant, recompute=False)
+    zs = evaluate_grid(xs, ys, f, evaluator, recompute=False,
+                       workers=os.cpu_count())
     points = get_points(xs, ys, zs)
     XYZ = get_XYZ(points, nx, ny)
 
@@ -154,11 +282,11 @@ if __name__ == "__main__":
     ## test gradient ascent with x0 close to max
     x0 = np.array([20, 5])
     sigma = 1
-    xs = gradient_ascent(plant, x0, grad, sigma, max_iter=5)
+    xs = gradient_ascent(evaluator, x0, grad, sigma, max_iter=5)
     gradient_plot(plant, xs, XYZ, 'close')
 
     ## test gradient ascent with x0 far from max
     x0 = np.array([2, 2])
     sigma = 1
-    xs = gradient_ascent(plant, x0, grad, sigma, max_iter=5)
+    xs = gradient_ascent(evaluator, x0, grad, sigma, max_iter=5)
     gradient_plot(plant, xs, XYZ, 'far')
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" library.py - packed library of many layouts in one directory, read
+    through memory mapping:
+        * coords.bin: coordinates of all layouts as contiguous float64 pairs
+        * index.bin: records of INDEX_DTYPE, one for each layout
+        * meta.json: names of the plants and of the named layouts
+    The layouts are appended to the ends of the files, a layout is in the
+    library once its index record is written.
+
+    Usage:
+        library.py import library.lib ../data/layouts/*.json
+        library.py export library.lib ../data/layouts
+        library.py info library.lib """
+
+import os
+import sys
+import numpy as np
+import utils
+
+## index record of a layout: first row in coords.bin, number of heliostats,
+## plant number in meta.json and energy, nan if not evaluated and -inf if
+## the layout is not valid
+INDEX_DTYPE = np.dtype([("offset", "<i8"), ("n", "<i4"), ("plant", "<i4"),
+                        ("energy", "<f8")])
+COORDS_DTYPE = np.dtype("<f8")
+
+class LayoutLibrary:
+    ''' Library of layouts in the directory path. With mode "r" it is read
+    only, with mode "a" it is created if it does not exist and layouts can be
+    appended and their energies set.
+
+    For example:
+        library = LayoutLibrary("../data/results/random.lib", "a")
+        library.append(layouts, "Tiny Plant")
+        for start, layouts in library.iter_blocks(10000):
+            energies, valid = utils.evaluate_many(layouts, plant_d)
+            library.set_energies(np.arange(start, start + len(layouts)), energies)
+    '''
+    def __init__(self, path, mode="r"):
+        if mode not in ["r", "a"]:
+            raise ValueError("mode must be 'r' or 'a', not " + mode)
+        self.path = path
+        self.mode = mode
+        self.coords_name = os.path.join(path, "coords.bin")
+        self.index_name = os.path.join(path, "index.bin")
+        self.meta_name = os.path.join(path, "meta.json")
+        if mode == "a" and not os.path.exists(self.meta_name):
+            os.makedirs(path, exist_ok=True)
+            for file_name in [self.coords_name, self.index_name]:
+                open(file_name, "ab").close()
+            self.meta = {"plants": [], "names": {}}
+            self.save_meta()
+        self.meta = utils.load(self.meta_name)
+        self.open()
+
+    def open(self):
+        ''' Memory maps the files, the coordinates past the last indexed
+        layout and a partial index record are left from an interrupted
+        append and are ignored. Only the index is writable, for the
+        energies, the coordinates are read only. '''
+        size = os.path.getsize(self.index_name) // INDEX_DTYPE.itemsize
+        if size == 0:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        else:
+            self.index = np.memmap(self.index_name, dtype=INDEX_DTYPE,
+                mode="r" if self.mode == "r" else "r+", shape=(size,))
+        if size == 0 or self.index[-1]["offset"] + self.index[-1]["n"] == 0:
+            self.coords = np.zeros((0, 2), dtype=COORDS_DTYPE)
+        else:
+            rows = int(self.index[-1]["offset"] + self.index[-1]["n"])
+            self.coords = np.memmap(self.coords_name, dtype=COORDS_DTYPE,
+                                    mode="r", shape=(rows, 2))
+
+    def flush(self):
+        if isinstance(self.index, np.memmap):
+            self.index.flush()
+
+    def save_meta(self):
+        ''' Saves meta.json, the file is replaced at once so an interruption
+        leaves the previous one. '''
+        temp_name = self.meta_name + ".tmp"
+        utils.save(self.meta, temp_name)
+        os.replace(temp_name, self.meta_name)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, k):
+        ''' Returns the layout k as a read only view of shape (n, 2). '''
+        record = self.index[k]
+        layout = self.coords[record["offset"]:record["offset"] + record["n"]]
+        layout = layout.view()
+        layout.flags.writeable = False
+        return layout
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    @property
+    def energies(self):
+        return self.index["energy"]
+
+    @property
+    def ns(self):
+        return self.index["n"]
+
+    def get_plant(self, k):
+        ''' Returns the name of the plant of layout k. '''
+        return self.meta["plants"][self.index[k]["plant"]]
+
+    def get_name(self, k):
+        ''' Returns the name of layout k, "layout-<k>" if it has none. '''
+        return self.meta["names"].get(str(k), "layout-{:d}".format(k))
+
+    def get_layouts(self, start=0, stop=None):
+        ''' Returns the layouts start, ..., stop - 1 at once: as one read only
+        array of shape (S, n, 2), a view of the coordinates without copying,
+        if they all have n heliostats, else as a list of arrays. '''
+        if stop is None:
+            stop = len(self)
+        stop = min(stop, len(self))
+        if stop <= start:
+            return np.zeros((0, 0, 2), dtype=COORDS_DTYPE)
+        ns = self.index["n"][start:stop]
+        if np.all(ns == ns[0]):
+            first = self.index[start]["offset"]
+            return self.coords[first:first + np.sum(ns)].reshape((-1, ns[0], 2))
+        return [self[k] for k in range(start, stop)]
+
+    def iter_blocks(self, size=10000):
+        ''' Yields the first index and the layouts of blocks of at most size
+        layouts, see get_layouts. '''
+        for start in range(0, len(self), size):
+            yield start, self.get_layouts(start, start + size)
+
+    def append(self, layouts, plant_name, energies=None, names=None):
+        ''' Appends the layouts, a list of arrays of shape (n, 2) or one array
+        of shape (S, n, 2), of the plant with optional energies and names.
+        Returns the indices of the appended layouts. '''
+        if self.mode == "r":
+            raise ValueError("library {} is read only".format(self.path))
+        layouts = [np.asarray(layout, dtype=COORDS_DTYPE).reshape((-1, 2))
+                   for layout in layouts]
+        if plant_name not in self.meta["plants"]:
+            self.meta["plants"].append(plant_name)
+        records = np.zeros(len(layouts), dtype=INDEX_DTYPE)
+        ns = np.array([len(layout) for layout in layouts], dtype=int)
+        records["n"] = ns
+        records["offset"] = len(self.coords) + np.cumsum(ns) - ns
+        records["plant"] = self.meta["plants"].index(plant_name)
+        records["energy"] = np.nan if energies is None else energies
+        start = len(self)
+
+        ## meta.json and the coordinates first, so the index never points
+        ## past them, both files are cut after the last complete layout
+        for key in [key for key in self.meta["names"] if int(key) >= start]:
+            del self.meta["names"][key]
+        if names is not None:
+            for k, name in enumerate(names):
+                self.meta["names"][str(start + k)] = name
+        self.save_meta()
+        self.flush()
+        with open(self.coords_name, "r+b") as file:
+            file.seek(len(self.coords) * 2 * COORDS_DTYPE.itemsize)
+            if layouts:
+                file.write(np.concatenate(layouts).tobytes())
+            file.truncate()
+        with open(self.index_name, "r+b") as file:
+            file.seek(start * INDEX_DTYPE.itemsize)
+            file.write(records.tobytes())
+            file.truncate()
+        self.open()
+        return np.arange(start, len(self))
+
+    def set_energies(self, indices, energies):
+        ''' Sets the energies of the layouts with the indices. '''
+        if self.mode == "r":
+            raise ValueError("library {} is read only".format(self.path))
+        self.index["energy"][indices] = energies
+        self.flush()
+
+    def __str__(self):
+        out = "LayoutLibrary {}: {} layouts".format(self.path, len(self))
+        for plant, name in enumerate(self.meta["plants"]):
+            ns = self.index["n"][self.index["plant"] == plant]
+            out += "\n\t- {}: {} layouts, n = {}".format(
+                name, len(ns), sorted(set(ns.tolist())))
+        evaluated = ~np.isnan(self.energies)
+        if np.any(np.isfinite(self.energies)):
+            out += "\n\t- {} evaluated, {} invalid, best energy {:.4f} of {}".format(
+                np.sum(evaluated), np.sum(np.isneginf(self.energies)),
+                np.nanmax(self.energies),
+                self.get_name(int(np.nanargmax(self.energies))))
+        return out
+
+def import_json(library, file_names, plant_name="Tiny Plant"):
+    ''' Appends the layouts of the JSON files, see utils.save_layout, named
+    by the file names. Returns their indices. '''
+    layouts = [utils.load(file_name) for file_name in file_names]
+    names = [os.path.splitext(os.path.basename(file_name))[0]
+             for file_name in file_names]
+    return library.append(layouts, plant_name, names=names)
+
+def export_json(library, directory, indices=None):
+    ''' Saves the layouts with the indices, all by default, to JSON files
+    named by the layouts in the directory, in the format of
+    utils.save_layout. '''
+    if indices is None:
+        indices = range(len(library))
+    for k in indices:
+        file_name = os.path.join(directory, library.get_name(k) + ".json")
+        utils.save(library[k].tolist(), file_name, indent=4)
+
+if __name__ == "__main__":
+    command, path = sys.argv[1], sys.argv[2]
+    if command == "import":
+        library = LayoutLibrary(path, "a")
+        indices = import_json(library, sys.argv[3:])
+        print("imported {} layouts".format(len(indices)))
+    elif command == "export":
+        library = LayoutLibrary(path)
+        export_json(library, sys.argv[3])
+    library = LayoutLibrary(path)
+    print(library)
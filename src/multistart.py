@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" multistart.py - local optimizations with SLSQP or COBYLA from many
+    diverse valid starting layouts in parallel. The workers share the best
+    energy found so far and abandon the starts that fall too far behind.
+
+    Usage, for example:
+        multistart.py sqp --n 5 --starts 32 --save multistart-layout """
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from plant import Plant
+from runner import Run, BudgetExceeded, get_bounds, optimize_method
+import screening
+import utils
+
+## a start is abandoned if after MIN_EVALS evaluations its best energy is
+## more than GAP below the best energy of all starts
+MIN_EVALS = 100
+GAP = 0.05
+
+class StartAbandoned(Exception):
+    pass
+
+class StartRun(Run):
+    ''' Run of one start that shares the best energy of the valid layouts
+    with the other starts through incumbent, a multiprocessing.Value. '''
+    def __init__(self, plant, method, incumbent, min_evals=MIN_EVALS, gap=GAP,
+                 **kwargs):
+        Run.__init__(self, plant, method, **kwargs)
+        self.incumbent = incumbent
+        self.min_evals = min_evals
+        self.gap = gap
+        self.best_valid_energy = -np.inf
+        self.best_valid_x = None
+
+    def update(self, xs, energies, valid):
+        valid_energies = np.where(valid, energies, -np.inf)
+        best = np.argmax(valid_energies)
+        if valid_energies[best] > self.best_valid_energy:
+            self.best_valid_energy = float(valid_energies[best])
+            self.best_valid_x = np.array(xs[best], dtype=float)
+            with self.incumbent.get_lock():
+                if self.best_valid_energy > self.incumbent.value:
+                    self.incumbent.value = self.best_valid_energy
+        Run.update(self, xs, energies, valid)
+        if self.evaluations >= self.min_evals and \
+           self.best_valid_energy < (1 - self.gap) * self.incumbent.value:
+            raise StartAbandoned()
+
+## plant and shared best energy of the worker process
+worker_plant = None
+worker_incumbent = None
+
+def init_worker(plant_d, incumbent):
+    global worker_plant, worker_incumbent
+    worker_plant = Plant(plant_d=plant_d)
+    worker_incumbent = incumbent
+
+def optimize_start(k, layout, method, max_evals=np.inf, min_evals=MIN_EVALS,
+                   gap=GAP, seed=None):
+    ''' Optimizes the start k with the method in the worker process and
+    returns the statistics of the start. '''
+    start = time.perf_counter()
+    plant = worker_plant
+    engine = "interval" if method == "sqp" else "batch"
+    run = StartRun(plant, method, worker_incumbent, min_evals, gap,
+                   max_evals=max_evals, engine=engine)
+    x0 = np.array(layout, dtype=float).flatten()
+    start_energy = -run.f(x0)
+    status = "converged"
+    try:
+        optimize_method(run, method, x0, get_bounds(plant, plant.n), seed)
+    except StartAbandoned:
+        status = "abandoned"
+    except BudgetExceeded:
+        status = "budget"
+    return {"start": k,
+            "start_energy": start_energy,
+            "energy": run.best_valid_energy,
+            "layout": None if run.best_valid_x is None else \
+                run.best_valid_x.reshape((-1, 2)).tolist(),
+            "evaluations": run.evaluations,
+            "time": time.perf_counter() - start,
+            "status": status}
+
+def get_starts(plant, n, n_starts, candidates=10, seed=None):
+    ''' Returns n_starts valid random layouts of n heliostats, chosen from
+    candidates * n_starts random valid layouts by farthest point sampling, so
+    that the starts are spread out. The heliostats of a layout are sorted
+    by the x coordinate to compare the layouts. '''
+    rng = np.random.default_rng(seed)
+    layouts = []
+    while len(layouts) < candidates * n_starts:
+        samples = rng.uniform((plant.x_min, plant.y_min),
+                              (plant.x_max, plant.y_max),
+                              (candidates * n_starts, n, 2))
+        valid = screening.get_valid(plant, samples)
+        layouts.extend(samples[valid])
+    layouts = np.array(layouts[:candidates * n_starts])
+
+    features = np.array([layout[np.argsort(layout[:, 0])].flatten()
+                         for layout in layouts])
+    chosen = [0]
+    distances = np.linalg.norm(features - features[0], axis=1)
+    while len(chosen) < n_starts:
+        k = int(np.argmax(distances))
+        chosen.append(k)
+        distances = np.minimum(distances,
+                               np.linalg.norm(features - features[k], axis=1))
+    return layouts[chosen]
+
+def multistart(plant_d, starts, method="sqp", workers=None, max_evals=np.inf,
+               min_evals=MIN_EVALS, gap=GAP, seed=None, verbose=True):
+    ''' Optimizes the plant from each of the starting layouts with the method
+    in a pool of workers processes. Returns the best layout, its energy and
+    the statistics of the starts in the input order. '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    incumbent = multiprocessing.Value("d", -np.inf)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(plant_d, incumbent)) as executor:
+        futures = [executor.submit(optimize_start, k, layout, method,
+                                   max_evals, min_evals, gap, seed)
+                   for k, layout in enumerate(starts)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if verbose:
+                print("start {:3d}: {:9s} {:10.4f}, best {:10.4f}".format(
+                    result["start"], result["status"], result["energy"],
+                    incumbent.value))
+
+    results.sort(key=lambda result: result["start"])
+    best = max(results, key=lambda result: result["energy"])
+    return np.array(best["layout"]), best["energy"], results
+
+def print_stats(results):
+    print("{:>5s} {:>10s} {:>10s} {:>11s} {:>8s} {:>10s}".format(
+        "start", "start", "energy", "evaluations", "time [s]", "status"))
+    for result in results:
+        print("{:5d} {:10.4f} {:10.4f} {:11d} {:8.2f} {:>10s}".format(
+            result["start"], result["start_energy"], result["energy"],
+            result["evaluations"], result["time"], result["status"]))
+    statuses = [result["status"] for result in results]
+    print("{} starts: {} converged, {} abandoned, {} out of budget".format(
+        len(results), statuses.count("converged"), statuses.count("abandoned"),
+        statuses.count("budget")))
+    print("evaluations: {:d}, time of the starts: {:.1f} s".format(
+        sum(result["evaluations"] for result in results),
+        sum(result["time"] for result in results)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Multi-start local optimization of the layout of n heliostats.")
+    parser.add_argument("method", choices=["sqp", "cobyla"])
+    parser.add_argument("--plant", default="../data/plants/tiny-plant.json")
+    parser.add_argument("--n", type=int, default=5)
+    parser.add_argument("--starts", type=int, default=32)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-evals", type=float, default=np.inf,
+                        help="budget of evaluations of each start")
+    parser.add_argument("--min-evals", type=int, default=MIN_EVALS)
+    parser.add_argument("--gap", type=float, default=GAP)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--save", help="name of the best layout in ../data/layouts")
+    args = parser.parse_args()
+
+    plant_d = utils.load(args.plant)
+    plant = Plant(plant_d=plant_d)
+    starts = get_starts(plant, args.n, args.starts, seed=args.seed)
+
+    start = time.perf_counter()
+    x, energy, results = multistart(plant_d, starts, args.method, args.workers,
+        args.max_evals, args.min_evals, args.gap, args.seed)
+    print_stats(results)
+    print("wall time: {:.1f} s".format(time.perf_counter() - start))
+
+    plant.layout = x
+    plant.set_layout()
+    print(plant.valid_layout)
+    print(utils.get_energy(plant))
+    if args.save:
+        utils.save_layout(x[:, 0], x[:, 1], args.save)
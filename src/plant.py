@@ -3,17 +3,44 @@
 
 import json
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import geometry
 import utils
 
+## for more heliostats than this the pairwise distances are found with a
+## KD-tree and the convex hull instead of all pairs, scipy is imported only
+## for them
+KD_TREE_MIN = 500
+
+## floating point types of the reflected vectors and everything computed
+## from them, see Plant.set_layout; the ray points are stored in double
+## precision, or in single precision with "float32"
+PRECISIONS = ["float32", "float64", "float128"]
+DEFAULT_PRECISION = "float128"
+
+def get_distances(us, vs, near=None):
+    ''' Returns the distances between points us and vs of shape (k, 2), the
+    same as np.linalg.norm(u - v) of each pair. The vectorized distances can
+    differ in the last bit, so the ones within rounding of near, defaults to
+    the maximum distance, are recomputed with np.linalg.norm. '''
+    vs = np.broadcast_to(vs, us.shape)
+    dists = np.sqrt(np.sum((us - vs)**2, axis=1))
+    if len(dists) == 0:
+        return dists
+    if near is None:
+        near = np.max(dists)
+    for k in np.flatnonzero(np.abs(dists - near) <= 1e-12 * (1 + near)):
+        dists[k] = np.linalg.norm(us[k] - vs[k])
+    return dists
+
 class Plant:
     ''' Constructs a plant given the plants specifications and heliostats layout.
     Args:
         * layout as a list of coordinates, for example: [[1, 2], [3, 4]]
         * plant_d as a dictionary, see ../data/plants/tiny-plant.json
+        * precision: one of PRECISIONS, defaults to plant_d["precision"] if
+        given, else DEFAULT_PRECISION
     '''
-    def __init__(self, layout=[[0, 0]], plant_d=None):
+    def __init__(self, layout=[[0, 0]], plant_d=None, precision=None):
         self.dim = 2
 
         if plant_d is None:
@@ -21,6 +48,11 @@ class Plant:
 
         self.name = plant_d["name"]
 
+        ## numeric precision
+        if precision is None:
+            precision = plant_d.get("precision", DEFAULT_PRECISION)
+        self.set_precision(precision)
+
         ## field area bounds and diameter
         self.x_min = plant_d["field_area"]["x_min"]
         self.x_max = plant_d["field_area"]["x_max"]
@@ -60,44 +92,163 @@ class Plant:
         '''
         self.n = self.layout.shape[0]
         heli_refs = self.rec_c - self.layout
-        heli_refs = heli_refs.astype("float128")
-        self.ref_lengths = np.apply_along_axis(np.linalg.norm, 1, heli_refs)
+        heli_refs = heli_refs.astype(self.dtype)
+        self.ref_lengths = np.sqrt(np.sum(heli_refs**2, axis=1))
         heli_refs = heli_refs / np.array([self.ref_lengths, self.ref_lengths]).T
-        self.heli_refs = self.layout + heli_refs
+        self.heli_refs = self.layout.astype(self.dtype) + heli_refs
+        self.heli_aas = self.get_atmospheric_attenuation()
         self.valid_layout = self.check_layout()
+        self.windows = None
         if self.n == 1:
             self.max_ij = self.y_max
         else:
             self.max_ij = self.get_max_ij()
 
+    def get_windows(self, d_factor):
+        ''' Returns the interaction windows of the heliostats for rays
+        multiplied by d_factor, computed once for each layout, as sparse
+        lists of pairs:
+            * (pairs_i, pairs_k, centers, half_widths) of the pairs closer
+            than the sun rays plus the reach, where heliostat k can shade
+            heliostat i only for the sun angles in the window, see
+            geometry.get_shading_windows
+            * (pairs_i, pairs_k) where k can block i, see
+            geometry.get_blocking_pairs
+        The candidates of shading are found as in get_pairs, their number
+        grows as n**2 on fields shorter than the sun rays, State(grid=True)
+        does not use the windows.
+        '''
+        if self.windows is None or self.windows[0] != d_factor:
+            reach = geometry.get_reach(self.heli_size)
+            pairs = self.get_pairs(self.max_ij * d_factor + reach)[0]
+            pairs_i = np.concatenate((pairs[:, 0], pairs[:, 1]))
+            pairs_k = np.concatenate((pairs[:, 1], pairs[:, 0]))
+            shading = (pairs_i, pairs_k) + geometry.get_shading_windows(
+                self.layout, self.heli_size, pairs_i, pairs_k)
+
+            ## all pairs are the candidates of blocking for small layouts
+            candidates = None
+            if self.n <= KD_TREE_MIN:
+                candidates = np.nonzero(~np.eye(self.n, dtype=bool))
+            blocking = geometry.get_blocking_pairs(self.layout, self.heli_size,
+                self.heli_refs - self.layout, self.ref_lengths * d_factor,
+                candidates)
+            self.windows = d_factor, shading, blocking
+        return self.windows[1:]
+
+    def set_precision(self, precision):
+        ''' Sets the floating point type of heli_refs, ref_lengths, heli_aas and
+        the arrays computed from them, and ray_dtype of the ray points. Call
+        set_layout after changing the precision of a plant. '''
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of {}, not {}".format(
+                PRECISIONS, precision))
+        self.precision = precision
+        self.dtype = np.dtype(precision)
+        self.ray_dtype = np.dtype("float32" if precision == "float32" else "float64")
+
+    def get_atmospheric_attenuation(self):
+        ''' Returns the atmospheric attenuation of the reflected rays for all
+        heliostats, it does not depend on the sun angle. '''
+        di = self.ref_lengths
+        return np.where(di <= 1000,
+            0.99321 - 0.0001176 * di + 1.97 * 10**(-8) * di**2,
+            np.exp(-0.0001106 * di))
+
     def get_max_ij(self):
-        max_ij = 0
-        for i in range(self.n):
-            for j in range(i + 1, self.n):
-                dist_ij = np.linalg.norm(self.layout[i] - self.layout[j])
-                if dist_ij > max_ij:
-                    max_ij = dist_ij
+        ''' Returns half of the maximum distance between heliostats. The
+        farthest pair is among the vertices of the convex hull of the layout.
+        '''
+        points = self.layout
+        if self.n > KD_TREE_MIN:
+            from scipy.spatial import ConvexHull, QhullError
+            try:
+                points = self.layout[ConvexHull(self.layout).vertices]
+            except QhullError:
+                ## all heliostats on a line, the hull is not defined
+                pass
+        if len(points) <= KD_TREE_MIN:
+            pairs = np.column_stack(np.triu_indices(len(points), k=1))
+        else:
+            ## the farthest point from each point
+            pairs = np.array([[i, i + 1 + np.argmax(
+                np.sum((points[i + 1:] - points[i])**2, axis=1))]
+                for i in range(len(points) - 1)])
+        max_ij = np.max(get_distances(points[pairs[:, 0]], points[pairs[:, 1]]))
         return max_ij/2
 
-    def check_layout(self):
+    def get_pairs(self, r):
+        ''' Returns the pairs of heliostats i < j closer than r as an array
+        of shape (p, 2) and their distances of shape (p,). '''
+        if self.n > KD_TREE_MIN:
+            from scipy.spatial import cKDTree
+            pairs = cKDTree(self.layout).query_pairs(r, output_type="ndarray")
+        else:
+            pairs = np.column_stack(np.triu_indices(self.n, k=1))
+        pairs = pairs.reshape((-1, 2))
+        dists = get_distances(self.layout[pairs[:, 0]], self.layout[pairs[:, 1]], r)
+        close = dists < r
+        return pairs[close], dists[close]
+
+    def get_violations(self):
+        ''' Returns the violated constraints of the layout as a dictionary of
+        (indices, depths), where depths are the distances by which the
+        constraints are violated:
+            * "field": heliostats outside of the field area
+            * "receiver": heliostats closer than d_min to the receiver
+            * "pairs": pairs of heliostats (i, j) closer than d_min
+        '''
         eps = 1e-5
-        if np.any(self.layout[:, 0] > self.x_max + eps):
-            return False
-        if np.any(self.layout[:, 0] < self.x_min - eps):
-            return False
-        if np.any(self.layout[:, 1] > self.y_max + eps):
-            return False
-        if np.any(self.layout[:, 1] < self.y_min - eps):
-            return False
-
-        for i in range(self.n):
-            if np.linalg.norm(self.layout[i] - self.rec_c) < self.d_min:
-                return False
-            for j in range(i + 1, self.n):
-                dist_ij = np.linalg.norm(self.layout[i] - self.layout[j])
-                if dist_ij < self.d_min:
-                    return False
-        return True
+        lows = np.array([self.x_min, self.y_min])
+        highs = np.array([self.x_max, self.y_max])
+        outside = np.max(np.maximum(lows - self.layout, self.layout - highs), axis=1)
+        field = np.flatnonzero(outside > eps)
+
+        rec_dists = get_distances(self.layout, self.rec_c[None], self.d_min)
+        receiver = np.flatnonzero(rec_dists < self.d_min)
+
+        pairs, dists = self.get_pairs(self.d_min)
+        return {"field": (field, outside[field]),
+                "receiver": (receiver, self.d_min - rec_dists[receiver]),
+                "pairs": (pairs, self.d_min - dists)}
+
+    def get_clearances(self):
+        ''' Returns for each heliostat the distance to the nearest other
+        heliostat or the receiver minus d_min, the layout keeps the minimum
+        distances if all are non negative. Can be used as inequality
+        constraints of optimizers. '''
+        rec_dists = get_distances(self.layout, self.rec_c[None], self.d_min)
+        if self.n == 1:
+            nearest = np.full(1, np.inf)
+        elif self.n > KD_TREE_MIN:
+            from scipy.spatial import cKDTree
+            nearest = cKDTree(self.layout).query(self.layout, k=2)[0][:, 1]
+        else:
+            dists = np.sqrt(np.sum(
+                (self.layout[:, None] - self.layout[None])**2, axis=2))
+            np.fill_diagonal(dists, np.inf)
+            nearest = np.min(dists, axis=1)
+        return np.minimum(nearest, rec_dists) - self.d_min
+
+    def check_layout(self):
+        ''' Returns True if there are no violations, see get_violations. '''
+        violations = self.get_violations()
+        return all(len(indices) == 0 for indices, depths in violations.values())
+
+    def get_spec(self):
+        ''' Returns the plant specs as a dictionary in the same format as
+        ../data/plants/tiny-plant.json. '''
+        return {
+            "name": self.name,
+            "field_area": {"x_min": self.x_min, "x_max": self.x_max,
+                           "y_min": self.y_min, "y_max": self.y_max,
+                           "d_min": self.d_min},
+            "receiver": {"rec_height": self.rec_height,
+                         "rec_angle": float(np.degrees(self.rec_angle)),
+                         "rec_size": self.rec_size},
+            "heliostats": {"heli_size": self.heli_size,
+                           "heli_rays": self.heli_rays},
+            "precision": self.precision}
 
     def __str__(self):
         out = ""
@@ -127,6 +278,9 @@ class Plant:
         return out
 
     def draw(self, name=None):
+        ## matplotlib is imported only for drawing
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as patches
         fig, ax = plt.subplots()
         plt.axis('equal')
         x_margins = 2, 2 # for drawings
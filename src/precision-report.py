@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" precision-report.py - accuracy and speed of the numeric precisions of the
+    plant against float128 for the layouts in ../data/layouts, and the
+    fastest precision with relative errors below tol.
+
+    Usage:
+        precision-report.py [engine] [tol] """
+
+import sys
+import glob
+import os
+import time
+from plant import Plant, PRECISIONS
+import utils
+
+def measure(plant, engine, repeat=3):
+    ''' Returns the energy and the best time of repeat evaluations. '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        energy = utils.get_energy(plant, engine=engine)
+        times.append(time.perf_counter() - start)
+    return energy, min(times)
+
+if __name__ == "__main__":
+    engine = sys.argv[1] if len(sys.argv) > 1 else "batch"
+    tol = float(sys.argv[2]) if len(sys.argv) > 2 else 1e-6
+    reference = "float128"
+
+    print("relative errors against {}, engine = {}\n".format(reference, engine))
+    out = "{:24s} {:>9s}".format("layout", "energy")
+    for precision in PRECISIONS:
+        out += " {:>19s}".format(precision + " / time [s]")
+    print(out)
+
+    errors = {precision: [] for precision in PRECISIONS}
+    times = {precision: 0.0 for precision in PRECISIONS}
+    for file_name in sorted(glob.glob("../data/layouts/*.json")):
+        layout = utils.load(file_name)
+        energies, layout_times = {}, {}
+        for precision in PRECISIONS:
+            plant = Plant(layout, precision=precision)
+            energies[precision], layout_times[precision] = measure(plant, engine)
+            times[precision] += layout_times[precision]
+        out = "{:24s} {:9.2f}".format(os.path.basename(file_name), energies[reference])
+        for precision in PRECISIONS:
+            error = abs(energies[precision] - energies[reference]) / energies[reference]
+            errors[precision].append(error)
+            out += " {:>19s}".format("{:.1e} / {:.3f}".format(error, layout_times[precision]))
+        print(out)
+
+    print("\n{:10s} {:>10s} {:>10s} {:>8s}".format("precision", "max error",
+                                                 "time [s]", "speedup"))
+    for precision in PRECISIONS:
+        print("{:10s} {:10.1e} {:10.3f} {:8.2f}".format(precision,
+            max(errors[precision]), times[precision],
+            times[reference] / times[precision]))
+
+    within = [precision for precision in PRECISIONS
+              if max(errors[precision]) <= tol]
+    fastest = min(within, key=lambda precision: times[precision])
+    print("\nfastest precision with errors below {:.0e}: {}".format(tol, fastest))
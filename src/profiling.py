@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" profiling.py - optional instrumentation of State, utils.get_power and
+    utils.get_energy.
+
+    For example:
+        with profiling.profile() as stats:
+            utils.get_energy(plant)
+        print(stats)
+
+    The phases are timed with the wall clock:
+        * ray_points: geometry of the heliostats and the rays
+        * shading, blocking, missed: tests of the sun rays, reflected rays
+        and rays towards the receiver
+        * power: utils.get_power of a State
+        * stats: assembly of the stats in utils.get_energy
+        * energy: all of utils.get_energy, including the phases above
+    and the counters are:
+        * intersection_tests: segment intersection tests
+        * early_exits: shaded or blocked rays, where the loops of the
+        original get_not_sb exit early
+        * states: States constructed
+
+    Profiling is disabled unless inside profile(), then phase() returns a
+    shared empty context and count() returns at once.
+"""
+
+import time
+from contextlib import contextmanager, nullcontext
+
+## the Stats being recorded, None if profiling is disabled
+active = None
+
+NULL_PHASE = nullcontext()
+
+class Stats:
+    ''' Wall times and numbers of calls of the phases and the counters. '''
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def as_dict(self):
+        ''' Returns the stats as a dictionary, e.g. to save them to JSON. '''
+        return {"times": dict(self.times), "calls": dict(self.calls),
+                "counts": dict(self.counts)}
+
+    def __str__(self):
+        out = "Stats: "
+        for name, seconds in self.times.items():
+            out += "\n\t- {:s} = {:.4f} s in {:d} calls".format(
+                name, seconds, self.calls[name])
+        for name, value in self.counts.items():
+            out += "\n\t- {:s} = {:d}".format(name, value)
+        return out
+
+class Phase:
+    ''' Context that adds its wall time to the phase of the stats. '''
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+@contextmanager
+def profile():
+    ''' Records the stats of the code inside the context. '''
+    global active
+    previous = active
+    active = Stats()
+    try:
+        yield active
+    finally:
+        active = previous
+
+def phase(name):
+    ''' Returns the context timing the phase name. '''
+    if active is None:
+        return NULL_PHASE
+    return Phase(active, name)
+
+def count(name, value=1):
+    ''' Adds value to the counter name. '''
+    if active is not None:
+        active.add_count(name, value)
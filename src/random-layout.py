@@ -1,11 +1,19 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-""" random-layout.py - sample x,y uniformly at random. """
+""" random-layout.py - sample x,y uniformly at random.
 
+    Usage:
+        random-layout.py [screen]
+    with screen the layouts are screened with increasing fidelity, see
+    screening.py. """
+
+import sys
 import json
 import numpy as np
 from plant import Plant
 import utils
+from bound import EnergyBound, get_best
+import screening
 
 if __name__ == "__main__":
     ## Plant=Tiny, n=5 heliostats
@@ -14,24 +22,29 @@ if __name__ == "__main__":
 
     ## random layout
     nruns = 10000
-    max_energy = 0
-    best_layout = []
-    energies = []
+    layouts = []
     for i in range(nruns):
         ## we have to try until we get a valid layout
         xs = np.random.uniform(plant.x_min, plant.x_max, n)
         ys = np.random.uniform(plant.y_min, plant.y_max, n)
-        plant.layout = np.stack((xs, ys)).T
-        plant.set_layout()
-        if plant.valid_layout:
-            energy = utils.get_energy(plant, do_stats=False)
-            energies.append(energy)
-            if energy > max_energy:
-                max_energy = energy
-                best_layout = plant.layout
+        layouts.append(np.stack((xs, ys)).T)
 
-    print(max_energy, np.mean(energies), np.std(energies))
-    # 54.059498031189726 34.36608182585655  6.971024042017483  # 1000 runs
-    # 56.29071606490873  34.752847821956266 7.2430077703910385 # 3000 runs
+    if "screen" in sys.argv[1:]:
+        ## screen the valid layouts with increasing fidelity
+        finalists, energies, report = screening.screen(plant, layouts)
+        max_energy, best_layout = energies[0], layouts[finalists[0]]
+        print(max_energy)
+    else:
+        ## evaluate the valid layouts in parallel, skipping the layouts with
+        ## energy bound below the best energy
+        plant_d = utils.load("../data/plants/tiny-plant.json")
+        bound = EnergyBound(plant)
+        max_energy, best, n_evaluated = get_best(layouts, plant_d, bound)
+        if best is None:
+            print("no valid layout among the {} layouts".format(len(layouts)))
+            sys.exit(1)
+        best_layout = layouts[best]
+        print(max_energy, n_evaluated)
+    # 674.3885889771533 1156 # 10000 runs, best energy and evaluated layouts
 
     utils.save_layout(best_layout[:, 0], best_layout[:, 1], "random-layout")
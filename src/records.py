@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" records.py - columnar buffer of the per-timestep stats of many layouts,
+    filled by utils.get_energy(plant, out=...) without building DataFrames.
+"""
+
+import numpy as np
+
+## stats of each sun position, in the order of the stats of get_energy
+ETA_COLUMNS = ["mu_aa", "mu_cos", "mu_sbm"]
+SBM_COLUMNS = ["pi_sha", "pi_blo", "pi_mis"]
+COLUMNS = ["power"] + ETA_COLUMNS + SBM_COLUMNS
+
+def get_row(m):
+    ''' Returns a new row of stats, a dictionary of COLUMNS to arrays of
+    shape (m,). '''
+    return {column: np.zeros(m) for column in COLUMNS}
+
+def write_stats(out, t, power, etas_means, sbms_props):
+    ''' Writes the power, etas_means and sbms_props of shape (3,) of sun
+    position t to out, a mapping of COLUMNS to arrays of shape (m,). '''
+    out["power"][t] = power
+    for j, column in enumerate(ETA_COLUMNS):
+        out[column][t] = etas_means[j]
+    for j, column in enumerate(SBM_COLUMNS):
+        out[column][t] = sbms_props[j]
+
+class StatsBuffer:
+    ''' Preallocated stats of layouts in m sun positions. Column c of all
+    layouts is one array of shape (capacity, m), so the rows are views and
+    the buffer grows by doubling only when it is full.
+
+    For example:
+        buffer = StatsBuffer(sun.m, times=sun.times)
+        for layout in layouts:
+            plant.layout = layout
+            plant.set_layout()
+            utils.get_energy(plant, sun=sun, out=buffer.append())
+        buffer.export("../data/results/stats.npz")
+    '''
+    def __init__(self, m, capacity=1024, times=None):
+        self.m = m
+        self.size = 0
+        self.times = times
+        self.energies = np.full(capacity, np.nan)
+        self.data = np.full((len(COLUMNS), capacity, m), np.nan)
+
+    def reserve(self, size):
+        ''' Grows the buffer to hold at least size layouts. '''
+        capacity = len(self.energies)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity = max(1, 2 * capacity)
+        energies = np.full(capacity, np.nan)
+        energies[:self.size] = self.energies[:self.size]
+        data = np.full((len(COLUMNS), capacity, self.m), np.nan)
+        data[:, :self.size] = self.data[:, :self.size]
+        self.energies, self.data = energies, data
+
+    def get_row(self, k):
+        ''' Returns the stats of layout k as a dictionary of views of COLUMNS
+        of shape (m,) and of its "energy" of shape (1,), to pass as out to
+        get_energy. '''
+        self.reserve(k + 1)
+        self.size = max(self.size, k + 1)
+        row = {column: self.data[j, k] for j, column in enumerate(COLUMNS)}
+        row["energy"] = self.energies[k:k + 1]
+        return row
+
+    def append(self):
+        ''' Returns the row of the next layout, see get_row. '''
+        return self.get_row(self.size)
+
+    def put(self, k, energy, values):
+        ''' Stores the energy and the stats of layout k, values of shape
+        (len(COLUMNS), m). '''
+        self.get_row(k)
+        self.energies[k] = energy
+        self.data[:, k] = values
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, column):
+        ''' Returns the column of all layouts of shape (size, m). '''
+        return self.data[COLUMNS.index(column), :self.size]
+
+    def get_dataframe(self, k):
+        ''' Returns the stats of layout k as the DataFrame of get_energy. '''
+        import pandas as pd
+        d = {} if self.times is None else {"time": self.times}
+        for j, column in enumerate(COLUMNS):
+            d[column] = self.data[j, k]
+        return pd.DataFrame(d)
+
+    def export(self, file_name):
+        ''' Saves the energies, the columns and the times to an .npz file,
+        see load. '''
+        columns = {column: self[column] for column in COLUMNS}
+        times = np.array([] if self.times is None else self.times)
+        np.savez(file_name, energy=self.energies[:self.size], times=times,
+                 **columns)
+
+def load(file_name):
+    ''' Returns the StatsBuffer saved by StatsBuffer.export. '''
+    with np.load(file_name) as f:
+        size = len(f["energy"])
+        buffer = StatsBuffer(f["power"].shape[1], max(1, size),
+                             f["times"].tolist() or None)
+        buffer.size = size
+        buffer.energies[:size] = f["energy"]
+        for j, column in enumerate(COLUMNS):
+            buffer.data[j, :size] = f[column]
+    return buffer
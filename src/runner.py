@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" runner.py - runs an optimizer on n heliostats of a plant within a budget
+    of evaluations or time, with checkpoints to resume interrupted runs.
+
+    Usage, for example:
+        runner.py de --plant ../data/plants/hypo-plant.json --n 20 \\
+            --max-time 3600 --checkpoint ../data/results/de-20.json
+    and after an interruption the same with --resume.
+
+    The methods are "annealing", "basinhopping", "cobyla", "de" and "sqp",
+    with the same settings as the scripts of the same names. """
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import optimize
+from plant import Plant
+from cache import EnergyCache
+from store import ResultStore, DEFAULT_FILE
+import utils
+
+METHODS = ["annealing", "basinhopping", "cobyla", "de", "sqp"]
+
+class BudgetExceeded(Exception):
+    pass
+
+class Run:
+    ''' Objective of the optimizers: the negative energy of the layout x of
+    shape (2n,). It counts the evaluations, keeps the best valid layout and
+    raises BudgetExceeded when max_evals evaluations or max_time seconds are
+    used.
+    Every every seconds the state of the run is saved to checkpoint.
+    '''
+    def __init__(self, plant, method, max_evals=np.inf, max_time=np.inf,
+                 checkpoint=None, every=60, engine="batch", store=None):
+        self.plant = plant
+        self.method = method
+        self.max_evals = max_evals
+        self.max_time = max_time
+        self.checkpoint = checkpoint
+        self.every = every
+        self.engine = engine
+        self.store = store
+        self.cache = EnergyCache(store=store)
+
+        self.evaluations = 0
+        self.elapsed = 0.0
+        self.best_energy = -np.inf
+        self.best_x = None
+        self.optimizer_state = {}
+        self.start = time.perf_counter()
+        self.saved = self.start
+
+    def get_time(self):
+        return self.elapsed + time.perf_counter() - self.start
+
+    def update(self, xs, energies, valid):
+        ''' Counts the evaluations of the layouts xs, keeps the best valid one
+        and checks the budget. '''
+        self.evaluations += len(energies)
+        energies = np.where(valid, energies, -np.inf)
+        best = np.argmax(energies)
+        if energies[best] > self.best_energy:
+            self.best_energy = float(energies[best])
+            self.best_x = np.array(xs[best], dtype=float)
+        if self.checkpoint and time.perf_counter() - self.saved > self.every:
+            self.save()
+        if self.evaluations >= self.max_evals or self.get_time() >= self.max_time:
+            raise BudgetExceeded()
+
+    def set_layout(self, x):
+        self.plant.layout = np.reshape(x, (-1, 2))
+        self.plant.set_layout()
+
+    def is_valid(self, x):
+        self.set_layout(x)
+        return self.plant.valid_layout
+
+    def f(self, x):
+        self.set_layout(x)
+        misses = self.cache.misses
+        energy = self.cache.get_energy(self.plant, engine=self.engine)
+        if self.cache.misses > misses:
+            self.update([x], [energy], [self.plant.valid_layout])
+        return -energy
+
+    def get_energies(self, xs):
+        ''' Energies of the population xs of shape (2n, S), not counted. '''
+        layouts = xs.T.reshape((xs.shape[1], -1, 2))
+        if self.store is None:
+            return utils.get_energies(self.plant, layouts, engine=self.engine)
+        return self.store.get_energies(self.plant, layouts, engine=self.engine)
+
+    def f_population(self, xs):
+        ''' Vectorized objective of differential evolution, xs of shape
+        (2n, S) is a population of S layouts. '''
+        energies = self.get_energies(xs)
+        self.update(xs.T, energies, [self.is_valid(x) for x in xs.T])
+        return -energies
+
+    def jac(self, x):
+        ''' Gradient of f, see utils.get_gradient, counted as the 4n
+        evaluations of the central differences. '''
+        self.set_layout(x)
+        gradient = utils.get_gradient(self.plant, engine=self.engine)
+        self.evaluations += 4 * self.plant.n
+        return -gradient.flatten()
+
+    def save(self):
+        ''' Saves the state of the run to the checkpoint file, the file is
+        replaced at once so an interruption leaves the previous one. '''
+        d = {"method": self.method,
+             "plant": self.plant.get_spec(),
+             "n": self.plant.n,
+             "evaluations": self.evaluations,
+             "elapsed": self.get_time(),
+             "best_energy": self.best_energy,
+             "best_x": None if self.best_x is None else self.best_x.tolist(),
+             "optimizer_state": self.optimizer_state}
+        temp_name = self.checkpoint + ".tmp"
+        utils.save(d, temp_name)
+        os.replace(temp_name, self.checkpoint)
+        self.saved = time.perf_counter()
+
+    def load(self):
+        ''' Restores the state of the run from the checkpoint file. '''
+        d = utils.load(self.checkpoint)
+        if d["method"] != self.method or d["n"] != self.plant.n:
+            raise ValueError("checkpoint {} is of method {} with n = {}".format(
+                self.checkpoint, d["method"], d["n"]))
+        self.evaluations = d["evaluations"]
+        self.elapsed = d["elapsed"]
+        self.best_energy = d["best_energy"]
+        if d["best_x"] is not None:
+            self.best_x = np.array(d["best_x"])
+        self.optimizer_state = d["optimizer_state"]
+        self.start = time.perf_counter()
+
+def get_bounds(plant, n):
+    bounds = []
+    for i in range(n):
+        bounds.append((plant.x_min, plant.x_max))
+        bounds.append((plant.y_min, plant.y_max))
+    return bounds
+
+def optimize_de(run, bounds, x0, seed, maxiter=150):
+    ''' Differential evolution, the population, its energies and the number of
+    generations done are kept in the checkpoints, so a resumed run continues
+    from the population for the remaining generations without evaluating it
+    again, also when the budget is reached before the first generation. '''
+    state = run.optimizer_state
+    done = state.get("iterations", 0)
+    if done >= maxiter:
+        return
+    population = state.get("population")
+    if population is None:
+        init = "latinhypercube"
+    else:
+        init, x0 = np.array(population), None
+    saved = population is not None and "energies" in state
+
+    def f(xs):
+        nonlocal saved
+        if saved:
+            saved = False
+            if np.allclose(xs.T, population):
+                ## the saved population is not evaluated again
+                return -np.array(state["energies"])
+        if "energies" in state:
+            return run.f_population(xs)
+        ## the initial population is saved before its evaluation can exceed
+        ## the budget, and kept until the first generation is done
+        energies = run.get_energies(xs)
+        state["population"] = xs.T.tolist()
+        state["energies"] = energies.tolist()
+        run.update(xs.T, energies, [run.is_valid(x) for x in xs.T])
+        return -energies
+
+    def callback(intermediate_result):
+        state["population"] = intermediate_result.population.tolist()
+        state["energies"] = (-intermediate_result.population_energies).tolist()
+        state["iterations"] = done + intermediate_result.nit
+
+    optimize.differential_evolution(f, bounds, init=init, x0=x0,
+        vectorized=True, updating="deferred", maxiter=maxiter - done,
+        polish=False, rng=seed, callback=callback)
+
+def optimize_method(run, method, x0, bounds, seed):
+    ''' Runs the method from x0, the best layout is kept by run. '''
+    if method == "de":
+        optimize_de(run, bounds, x0, seed)
+    elif method == "annealing":
+        optimize.dual_annealing(run.f, bounds, x0=x0, maxiter=500, rng=seed)
+    elif method == "basinhopping":
+        optimize.basinhopping(run.f, x0, niter=10, rng=seed,
+            minimizer_kwargs={"bounds": bounds, "jac": run.jac})
+    elif method == "sqp":
+        optimize.minimize(run.f, x0, method="SLSQP", jac=run.jac,
+            bounds=bounds, options={"maxiter": 100})
+    elif method == "cobyla":
+        cons = [{"type": "ineq",
+                 "fun": lambda x: run.set_layout(x) or run.plant.get_clearances()}]
+        optimize.minimize(run.f, x0, method="COBYLA", bounds=bounds,
+            constraints=cons, options={"maxiter": 200})
+    else:
+        raise ValueError("unknown method: " + method)
+
+def run_optimizer(plant, method, max_evals=np.inf, max_time=np.inf,
+                  checkpoint=None, resume=False, every=60, engine=None, seed=None,
+                  store=None):
+    ''' Optimizes the layout of the plant starting from plant.layout within
+    the budget and returns the Run with the best layout. If resume, the run
+    continues from the checkpoint: the budget used so far is counted, the
+    local methods restart from the best layout and differential evolution
+    from the saved population. With a store.ResultStore the layouts
+    evaluated before are not simulated again. '''
+    if engine is None:
+        engine = "interval" if method in ["sqp", "basinhopping"] else "batch"
+    run = Run(plant, method, max_evals, max_time, checkpoint, every, engine,
+              store)
+    if resume and checkpoint and os.path.exists(checkpoint):
+        run.load()
+    x0 = np.array(plant.layout, dtype=float).flatten()
+    if run.best_x is not None:
+        x0 = run.best_x
+    bounds = get_bounds(plant, plant.n)
+
+    try:
+        optimize_method(run, method, x0, bounds, seed)
+        run.optimizer_state["finished"] = True
+    except BudgetExceeded:
+        print("Terminating optimization: budget reached")
+    if checkpoint:
+        run.save()
+    return run
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimizes the layout of n heliostats.")
+    parser.add_argument("method", choices=METHODS)
+    parser.add_argument("--plant", default="../data/plants/tiny-plant.json")
+    parser.add_argument("--n", type=int, default=5)
+    parser.add_argument("--layout",
+        help="file of the initial layout, defaults to a grid of n heliostats")
+    parser.add_argument("--max-evals", type=float, default=np.inf)
+    parser.add_argument("--max-time", type=float, default=np.inf, help="seconds")
+    parser.add_argument("--checkpoint", help="JSON file of the state of the run")
+    parser.add_argument("--every", type=float, default=60,
+                        help="seconds between checkpoints")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--engine", help="see utils.get_energy")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--save", help="name of the best layout in ../data/layouts")
+    parser.add_argument("--store", nargs="?", const=DEFAULT_FILE,
+                        help="result store database, see store.py")
+    args = parser.parse_args()
+
+    plant = Plant(plant_d=utils.load(args.plant))
+    if args.layout:
+        plant = Plant(utils.load(args.layout), utils.load(args.plant))
+    else:
+        plant.layout = utils.grid_layout(plant, args.n, jitter=0.3, seed=args.seed)
+        plant.set_layout()
+
+    run = run_optimizer(plant, args.method, args.max_evals, args.max_time,
+                        args.checkpoint, args.resume, args.every, args.engine,
+                        args.seed, ResultStore(args.store) if args.store else None)
+    print("evaluations: {:d}, time: {:.1f} s".format(run.evaluations, run.get_time()))
+
+    if run.best_x is None:
+        print("no valid layout was evaluated")
+        sys.exit(1)
+    x = run.best_x.reshape((-1, 2))
+    plant.layout = x
+    plant.set_layout()
+    print(plant.valid_layout)
+    print(utils.get_energy(plant))
+    if args.save:
+        utils.save_layout(x[:, 0], x[:, 1], args.save)
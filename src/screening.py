@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" screening.py - multi-fidelity screening of many layouts: all layouts are
+    evaluated with few sun steps and rays, and only the best ones are
+    evaluated again with more, up to the full accuracy of utils.get_energy.
+"""
+
+import copy
+import time
+import numpy as np
+from scipy import stats
+from sun import Sun
+import utils
+
+## fidelity levels: number of sun steps m, number of rays heli_rays (None
+## for the rays of the plant) and the number of the best layouts kept for
+## the next level
+LEVELS = [{"m": 17, "heli_rays": 5, "keep": 200},
+          {"m": 45, "heli_rays": 20, "keep": 20},
+          {"m": 180, "heli_rays": None, "keep": 20}]
+
+def get_valid(plant, layouts):
+    ''' Returns the indices of the valid layouts. '''
+    scratch = copy.copy(plant)
+    valid = []
+    for k, layout in enumerate(layouts):
+        scratch.layout = np.array(layout)
+        scratch.set_layout()
+        if scratch.valid_layout:
+            valid.append(k)
+    return np.array(valid, dtype=int)
+
+def screen(plant, layouts, levels=None, engine="batch", verbose=True):
+    ''' Screens the valid layouts of the plant through the fidelity levels.
+    In each level the remaining layouts are evaluated with Sun(m) and
+    heli_rays rays and the best keep of them go to the next level.
+    Returns:
+        * indices of the layouts kept in the last level, best first
+        * their energies in the last level
+        * report as a list of dictionaries for each level with the number
+        of evaluated layouts, the time and how the ranking of the layouts
+        changed from the previous level:
+            - spearman: rank correlation of the energies of the layouts in
+            both levels
+            - best_rank: rank of the best layout in the previous level
+            - top_overlap: proportion of the best keep layouts that were
+            also the best keep in the previous level
+    '''
+    if levels is None:
+        levels = LEVELS
+    candidates = get_valid(plant, layouts)
+    previous = None
+    report = []
+    for level in levels:
+        start = time.perf_counter()
+        scratch = copy.copy(plant)
+        if level["heli_rays"] is not None:
+            scratch.heli_rays = level["heli_rays"]
+        energies = utils.get_energies(scratch, [layouts[k] for k in candidates],
+                                      engine=engine, sun=Sun(level["m"]))
+        order = np.argsort(-energies, kind="stable")
+        row = {"m": level["m"], "heli_rays": scratch.heli_rays,
+               "evaluated": len(candidates),
+               "time": time.perf_counter() - start,
+               "spearman": None, "best_rank": None, "top_overlap": None}
+
+        if previous is not None and len(candidates) > 1:
+            ## previous energies of the candidates, in the same order
+            row["spearman"] = stats.spearmanr(previous, energies)[0]
+            previous_ranks = np.empty(len(candidates), dtype=int)
+            previous_ranks[np.argsort(-previous, kind="stable")] = \
+                np.arange(len(candidates))
+            row["best_rank"] = int(previous_ranks[order[0]])
+            keep = min(level["keep"], len(candidates))
+            row["top_overlap"] = np.mean(previous_ranks[order[:keep]] < keep)
+        report.append(row)
+
+        kept = order[:level["keep"]]
+        candidates, previous = candidates[kept], energies[kept]
+
+    if verbose:
+        print_report(report)
+    return candidates, previous, report
+
+def print_report(report):
+    print("{:>5s} {:>6s} {:>9s} {:>8s} {:>9s} {:>10s} {:>12s}".format(
+        "m", "rays", "evaluated", "time [s]", "spearman", "best rank", "top overlap"))
+    for row in report:
+        out = "{:5d} {:6d} {:9d} {:8.2f}".format(
+            row["m"], row["heli_rays"], row["evaluated"], row["time"])
+        if row["spearman"] is None:
+            out += " {:>9s} {:>10s} {:>12s}".format("-", "-", "-")
+        else:
+            out += " {:9.3f} {:10d} {:12.2f}".format(
+                row["spearman"], row["best_rank"], row["top_overlap"])
+        print(out)
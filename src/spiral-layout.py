@@ -1,11 +1,14 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from plant import Plant
 import utils
+from bound import EnergyBound, get_best
+import screening
 
 def draw_points(plant, spiral_points, masked_points):
     fig, ax = plt.subplots()
@@ -80,23 +83,29 @@ if __name__ == "__main__":
     xs = masked_points[:, 0]
     ys = masked_points[:, 1]
     nruns = 100
-    max_energy = 0
-    best_layout = []
-    energies = []
+    layouts = []
     for i in range(nruns):
         layout = []
         choices = np.random.choice(xs.shape[0], n, replace=False)
         for choice in choices:
             layout.append([xs[choice], ys[choice]])
-        plant.layout = np.array(layout)
-        plant.set_layout()
-        if plant.valid_layout:
-            energy = utils.get_energy(plant, do_stats=False)
-            energies.append(energy)
-            if energy > max_energy:
-                max_energy = energy
-                best_layout = plant.layout
-    print(max_energy, np.mean(energies), np.std(energies))
-    # 55.62450358372094 35.12028133879603 6.585674904294718 # 100 runs
-    # 55.520676322352706 33.56358388126249 6.718791163821474 # 3000 runs
+        layouts.append(np.array(layout))
+
+    if "screen" in sys.argv[1:]:
+        ## screen the valid layouts with increasing fidelity
+        finalists, energies, report = screening.screen(plant, layouts)
+        max_energy, best_layout = energies[0], layouts[finalists[0]]
+        print(max_energy)
+    else:
+        ## evaluate the valid layouts in parallel, skipping the layouts with
+        ## energy bound below the best energy
+        plant_d = utils.load("../data/plants/tiny-plant.json")
+        bound = EnergyBound(plant)
+        max_energy, best, n_evaluated = get_best(layouts, plant_d, bound)
+        if best is None:
+            print("no valid layout among the {} layouts".format(len(layouts)))
+            sys.exit(1)
+        best_layout = layouts[best]
+        print(max_energy, n_evaluated)
+    # 499.93062121190684 24 # 100 runs, best energy and evaluated layouts
     utils.save_layout(best_layout[:, 0], best_layout[:, 1], "spiral-random-layout")
@@ -6,12 +6,25 @@ import numpy as np
 from scipy import optimize
 from plant import Plant
 import utils
+from cache import EnergyCache
 import time
 
+## repeated evaluations of the same layout are cached
+cache = EnergyCache()
+
+@cache
 def f(x):
-    plant.layout = x.reshape((5, 2))
+    plant.layout = x.reshape((-1, 2))
+    plant.set_layout()
+    return -utils.get_energy(plant, engine="interval")
+
+@cache
+def jac(x):
+    ''' Gradient of f by central differences, each partial derivative moves
+    one heliostat, see utils.get_gradient. '''
+    plant.layout = x.reshape((-1, 2))
     plant.set_layout()
-    return -utils.get_energy(plant)
+    return -utils.get_gradient(plant).flatten()
 
 if __name__ == "__main__":
     ## Tiny plant, n=5 heliostats
@@ -32,6 +45,7 @@ if __name__ == "__main__":
     ## optimize
     result = optimize.minimize(f, x0,
                                method="SLSQP",
+                               jac=jac,
                                bounds=bounds,
                                options={
                                    'disp': True,
@@ -64,4 +78,5 @@ if __name__ == "__main__":
     print(plant.valid_layout)
     print(utils.get_energy(plant))
 
+    print(cache)
     utils.save_layout(x[:, 0], x[:, 1], "sqp-layout")
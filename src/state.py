@@ -2,44 +2,68 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import geometry
+import profiling
 
 class State:
     ''' '''
-    def __init__(self, plant, sun_angle):
+    d_factor = 1.5 # rays multiplier to ensure it hits
+
+    def __init__(self, plant, sun_angle, grid=False):
         '''
         Inputs:
             * object plant of class Plant: description of a plant
             * sun_angle: angle between 0 and \pi in radians
-            TODO: optimize
+            * grid: if True, the rays are tested only against the heliostats
+            and the receiver found in their corridor using a spatial index,
+            for large fields
         '''
         self.plant = plant
         self.sun_angle = sun_angle
-        self.d_factor = 1.5 # rays multiplier to ensure it hits
-
-        ## sun tangent vector
-        sun_vec = np.array([np.cos(self.sun_angle), np.sin(self.sun_angle)])
-        self.heli_suns = self.plant.layout + sun_vec
-
-        ## heliostats normals
-        heli_normals = self.plant.heli_refs + self.heli_suns - 2 * self.plant.layout
-        normal_lengths = np.apply_along_axis(np.linalg.norm, 1, heli_normals)
-        heli_normals = heli_normals / np.array([normal_lengths, normal_lengths]).T
-        self.heli_normals = self.plant.layout + heli_normals
-
-        ## heliostats tangent vectors and edge points
-        heli_tans = self.heli_normals - self.plant.layout
-        self.heli_tans = np.array([-heli_tans[:, 1], heli_tans[:, 0]]).T
-        self.heli_as = self.plant.layout + self.plant.heli_size / 2 * self.heli_tans
-        self.heli_bs = self.plant.layout - self.plant.heli_size / 2 * self.heli_tans
-
-        ## ray points
-        self.surf_points = np.zeros((self.plant.n, self.plant.heli_rays, self.plant.dim))
-        self.ref_ends = np.zeros((self.plant.n, self.plant.heli_rays, self.plant.dim))
-        self.sun_ends = np.zeros((self.plant.n, self.plant.heli_rays, self.plant.dim))
-        for i in range(self.plant.n):
-            self.surf_points[i], self.ref_ends[i], self.sun_ends[i] = self.get_ray_points(i)
+        profiling.count("states")
+
+        with profiling.phase("ray_points"):
+            ## sun vectors, heliostats normals, tangent vectors and edge points
+            self.heli_suns, self.heli_normals, self.heli_tans, \
+                self.heli_as, self.heli_bs = geometry.get_mirrors(
+                    self.plant.layout, self.plant.heli_refs,
+                    self.sun_angle, self.plant.heli_size)
+
+            ## ray points, stored in plant.ray_dtype
+            self.surf_points, self.ref_ends, self.sun_ends = [
+                points.astype(plant.ray_dtype) for points in geometry.get_ray_points(
+                    self.heli_bs, self.heli_tans,
+                    self.plant.heli_size, self.plant.heli_rays,
+                    self.plant.heli_refs - self.plant.layout, self.plant.ref_lengths,
+                    self.heli_suns - self.plant.layout, self.plant.max_ij,
+                    self.d_factor)]
+
+        ## uniform grids over the heliostats and the receiver
+        if grid:
+            self.heli_grid = geometry.SegmentGrid(self.heli_as, self.heli_bs)
+            self.rec_grid = geometry.SegmentGrid(
+                [self.plant.rec_a], [self.plant.rec_b])
+        else:
+            self.heli_grid, self.rec_grid = None, None
+
+        ## without a grid only the pairs of heliostats (i, k) where k can
+        ## shade or block i are tested, see Plant.get_windows
+        if grid:
+            self.shading_pairs, self.blocking_pairs = None, None
+        else:
+            (pairs_i, pairs_k, centers, half_widths), self.blocking_pairs = \
+                plant.get_windows(self.d_factor)
+            active = geometry.get_active_pairs(centers, half_widths,
+                                               [self.sun_angle])[1]
+            self.shading_pairs = pairs_i[active], pairs_k[active]
+
+        ## not shaded, not blocked and not missed rays of all heliostats
+        with profiling.phase("shading"):
+            self.not_shaded = self.get_not_sb_all(self.sun_ends)
+        with profiling.phase("blocking"):
+            self.not_blocked = self.get_not_sb_all(self.ref_ends)
+        with profiling.phase("missed"):
+            self.not_missed = self.get_not_missed_all()
 
     def __str__(self):
         out = "State: \n"
@@ -82,9 +106,9 @@ class State:
         not blocked and do not miss the receiver,
         * not_sbm_props = proportions of not shaded, not blocked and
         not missed rays. '''
-        not_shaded = self.get_not_sb(i, self.sun_ends)
-        not_blocked = self.get_not_sb(i, self.ref_ends)
-        not_missed = self.get_not_missed(i)
+        not_shaded = self.not_shaded[i]
+        not_blocked = self.not_blocked[i]
+        not_missed = self.not_missed[i]
         received = np.sum(not_shaded & not_blocked & not_missed)
 
         ## not shaded, not blocked and not missed rays
@@ -102,33 +126,78 @@ class State:
             * rays j = 2, 3, 4 are not shaded or blocked
         by any other heliostat.
         '''
-        not_sb = np.ones(self.plant.heli_rays, dtype=int)
-        for j in range(self.plant.heli_rays):
-            for k in range(self.plant.n):
-                if k != i:
-                    a, b = self.heli_as[k, :], self.heli_bs[k, :]
-                    c, d = self.surf_points[i, j, :], end_points[i, j, :]
-                    if self.intersect(a, b, c, d):
-                        not_sb[j] = 0
-                        break
-        return not_sb
+        hit = self.get_hit_rays(self.heli_grid, self.heli_as, self.heli_bs,
+            self.surf_points[i:i+1], end_points[i:i+1], own=np.array([i]),
+            pairs=self.get_pairs(end_points, [i]))
+        if profiling.active:
+            profiling.count("early_exits", np.count_nonzero(hit))
+        return (~hit[0]).astype(int)
+
+    def get_not_sb_all(self, end_points):
+        ''' Returns a matrix of not shaded or not blocked rays of shape
+        (n, heli_rays), where row i is get_not_sb(i, end_points), all rays
+        of all heliostats are tested against all heliostats at once. '''
+        hit = self.get_hit_rays(self.heli_grid, self.heli_as, self.heli_bs,
+            self.surf_points, end_points, own=np.arange(self.plant.n),
+            pairs=self.get_pairs(end_points, np.arange(self.plant.n)))
+        if profiling.active:
+            profiling.count("early_exits", np.count_nonzero(hit))
+        return (~hit).astype(int)
 
     def get_not_missed(self, i):
         ''' Returns which rays do not miss the receiver. '''
-        not_missed = np.zeros(self.plant.heli_rays, dtype=int)
-        for j in range(self.plant.heli_rays):
-            a, b = self.plant.rec_a, self.plant.rec_b
-            c, d = self.surf_points[i, j, :], self.ref_ends[i, j, :]
-            if self.intersect(a, b, c, d):
-                not_missed[j] = 1
-        return not_missed
+        hit = self.get_hit_rays(self.rec_grid,
+            self.plant.rec_a[None], self.plant.rec_b[None],
+            self.surf_points[i:i+1], self.ref_ends[i:i+1])
+        return hit[0].astype(int)
+
+    def get_not_missed_all(self):
+        ''' Returns which rays of all heliostats do not miss the receiver. '''
+        hit = self.get_hit_rays(self.rec_grid,
+            self.plant.rec_a[None], self.plant.rec_b[None],
+            self.surf_points, self.ref_ends)
+        return hit.astype(int)
+
+    def get_pairs(self, end_points, rows):
+        ''' Returns the pairs of heliostats that can interact for the rays of
+        the heliostats rows, from shading_pairs for the sun rays and
+        blocking_pairs for the reflected rays, with the heliostats numbered
+        by their positions in rows. None if all pairs are tested. '''
+        if end_points is self.sun_ends:
+            pairs = self.shading_pairs
+        elif end_points is self.ref_ends:
+            pairs = self.blocking_pairs
+        else:
+            pairs = None
+        if pairs is None:
+            return None
+        positions = np.full(self.plant.n, -1)
+        positions[rows] = np.arange(len(rows))
+        pairs_i, pairs_k = pairs
+        selected = positions[pairs_i] >= 0
+        return positions[pairs_i[selected]], pairs_k[selected]
+
+    def get_hit_rays(self, grid, seg_as, seg_bs, starts, ends, own=None,
+                     pairs=None):
+        ''' Returns which rays hit any of the segments, skipping own segments
+        as in geometry.get_hit_rays. With a grid over the segments only the
+        candidates found in the rays corridors are tested. With pairs, the
+        indices (pairs_i, pairs_k) of the rays starts and of the segments,
+        only the rays of the pairs are tested, the results are the same if
+        the other rays can not hit the segments. '''
+        if grid is not None:
+            pairs_i, pairs_k = grid.query(starts, ends, own)
+        elif pairs is not None:
+            pairs_i, pairs_k = pairs
+        else:
+            return geometry.get_hit_rays(seg_as, seg_bs, starts, ends, own)
+        if profiling.active:
+            profiling.count("skipped_pairs", len(starts) * len(seg_as) - len(pairs_i))
+        return geometry.get_hit_rays_pairs(seg_as, seg_bs, starts, ends,
+                                           pairs_i, pairs_k)
 
     def get_atmospheric_attenuation(self, i):
-        di = self.plant.ref_lengths[i]
-        if di <= 1000:
-            return 0.99321 - 0.0001176 * di + 1.97 * 10**(-8) * di**2
-        else:
-            return np.exp(-0.0001106 * di)
+        return self.plant.heli_aas[i]
 
     def get_ray_points(self, i):
         ''' Returns the points on the rays for heliostat i:
@@ -136,32 +205,7 @@ class State:
             * reflected rays ends towards the receiver
             * sun rays ends towards the sun
         '''
-        heli_a = np.array([self.heli_as[i, 0], self.heli_as[i, 1]])
-        heli_b = np.array([self.heli_bs[i, 0], self.heli_bs[i, 1]])
-        heli_tan = self.heli_tans[i]
-
-        # the surface points
-        surf_coefs = np.linspace(0.1, 0.9, self.plant.heli_rays)
-        mat_coefs = np.tile(surf_coefs, (2, 1))
-        mat_heli_b = np.tile(heli_b, (self.plant.heli_rays, 1)).T
-        mat_heli_tan = np.tile(heli_tan, (self.plant.heli_rays, 1)).T
-        surf_points = mat_heli_b + mat_coefs * mat_heli_tan * self.plant.heli_size
-        surf_points = surf_points.T
-
-        ref_ends = np.zeros((self.plant.heli_rays, self.plant.dim))
-        sun_ends = np.zeros((self.plant.heli_rays, self.plant.dim))
-        for j in range(self.plant.heli_rays):
-            surf_point = surf_points[j, :].T
-
-            # ray ends towards the receiver
-            ref_vec = self.plant.heli_refs[i] - self.plant.layout[i]
-            ref_ends[j] = surf_point + ref_vec * self.plant.ref_lengths[i] * self.d_factor
-
-            # draw the rays towards the sun
-            sun_vec = self.heli_suns[i] - self.plant.layout[i]
-            sun_ends[j] = surf_point + sun_vec * self.plant.max_ij * self.d_factor
-
-        return surf_points, ref_ends, sun_ends
+        return self.surf_points[i], self.ref_ends[i], self.sun_ends[i]
 
     def intersect(self, a, b, c, d):
         ''' Checks if line segment ab intersects cd.
@@ -190,6 +234,8 @@ class State:
         return True
 
     def draw(self, i, name=None):
+        ## matplotlib is imported only for drawing
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         plt.axis('equal')
         x_margins = 2, 2 # for drawings
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" store.py - persistent store of the energies and the stats of evaluated
+    layouts in an SQLite database, shared by the scripts and their worker
+    processes, so that a layout is simulated only once.
+
+    Usage:
+        store.py [info]
+        store.py evict max_entries
+        store.py compact """
+
+import os
+import sys
+import json
+import time
+import atexit
+import hashlib
+import sqlite3
+import numpy as np
+from sun import Sun
+import utils
+
+DEFAULT_FILE = "../data/results/results.db"
+
+## options of utils.get_energy by default, the keys of the same options
+## given explicitly or not are the same
+DEFAULT_OPTIONS = {"engine": "batch"}
+
+## number of hits whose access times are written at once, see flush
+ACCESS_BATCH = 1000
+
+class ResultStore:
+    ''' Energies and stats by a hash of the plant specs, the sun model, the
+    options of utils.get_energy and the layout rounded to multiples of tol.
+    The database is in write-ahead log mode, so many processes can read and
+    write it at once, a writer waits up to timeout seconds for the others.
+    Each process opens its own connection, so a store can be passed to
+    worker processes. Use get_energy in place of utils.get_energy:
+        store = ResultStore()
+        energy = store.get_energy(plant, engine="interval")
+    '''
+    def __init__(self, file_name=DEFAULT_FILE, timeout=60, tol=1e-9):
+        self.file_name = file_name
+        self.timeout = timeout
+        self.tol = tol
+        self.connection = None
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None
+        state["accessed"] = {}
+        return state
+
+    def connect(self):
+        ''' Returns the connection of this process. '''
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.file_name,
+                timeout=self.timeout, isolation_level=None)
+            self.pid = os.getpid()
+            atexit.register(self.close)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, plant TEXT, n INTEGER, energy REAL,
+                stats TEXT, created REAL, accessed REAL)""")
+            self.connection.execute("""CREATE INDEX IF NOT EXISTS
+                results_accessed ON results (accessed)""")
+        return self.connection
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self.flush()
+            self.connection.close()
+        self.connection = None
+
+    def flush(self):
+        ''' Writes the access times of the hits since the last flush in one
+        transaction. '''
+        if not self.accessed:
+            return
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany("UPDATE results SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self.accessed.items()])
+        connection.execute("COMMIT")
+        self.accessed = {}
+
+    def get_key(self, plant, layout=None, sun=None, **options):
+        ''' Returns the hash of the plant specs, the layout, defaults to
+        plant.layout, the sun model, defaults to Sun(180), and the options of
+        utils.get_energy, with DEFAULT_OPTIONS for the options not given. '''
+        options = dict(DEFAULT_OPTIONS, **options)
+        if layout is None:
+            layout = plant.layout
+        if sun is None:
+            sun = Sun(180)
+        layout = np.round(np.asarray(layout, dtype=float) / self.tol)
+        h = hashlib.sha256()
+        h.update(json.dumps(plant.get_spec(), sort_keys=True).encode())
+        h.update(repr(sorted(options.items())).encode())
+        h.update(np.asarray(sun.angles, dtype=float).tobytes())
+        h.update(np.asarray(sun.weights, dtype=float).tobytes())
+        h.update(layout.astype(np.int64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key, stats=False):
+        ''' Returns the stored energy of key, or (energy, stats_df) if stats,
+        None if the key or its stats are not stored. The access times of the
+        hits are written in batches of ACCESS_BATCH, see flush. '''
+        connection = self.connect()
+        row = connection.execute("SELECT energy, stats FROM results WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None or (stats and row[1] is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= ACCESS_BATCH:
+            self.flush()
+        if stats:
+            import pandas as pd
+            return row[0], pd.DataFrame(json.loads(row[1]))
+        return row[0]
+
+    def put(self, key, plant_name, n, energy, stats_df=None):
+        ''' Stores the energy and the optional stats of key for a layout of
+        n heliostats, the stats of an existing key are kept if not given. '''
+        stats = None
+        if stats_df is not None:
+            stats = json.dumps(stats_df.to_dict(orient="list"), default=float)
+        now = time.time()
+        self.connect().execute("""INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET energy = excluded.energy,
+            stats = COALESCE(excluded.stats, stats), accessed = excluded.accessed""",
+            (key, plant_name, n, float(energy), stats, now, now))
+
+    def get_energy(self, plant, do_stats=False, sun=None, **kwargs):
+        ''' Returns utils.get_energy(plant, do_stats, sun=sun, **kwargs) of the
+        current layout of the plant from the store, or simulates and stores
+        it. With do_stats the stats are not printed. '''
+        options = {key: value for key, value in kwargs.items() if key != "verbose"}
+        key = self.get_key(plant, sun=sun, **options)
+        if do_stats:
+            stored = self.get(key, stats=True)
+            if stored is not None:
+                energy, stats_df = stored
+                return energy, stats_df, stats_df["power"].values
+            kwargs["verbose"] = False
+            energy, stats_df, powers = utils.get_energy(plant, do_stats=True,
+                                                        sun=sun, **kwargs)
+            self.put(key, plant.name, plant.n, energy, stats_df)
+            return energy, stats_df, powers
+
+        energy = self.get(key)
+        if energy is None:
+            energy = utils.get_energy(plant, sun=sun, **kwargs)
+            self.put(key, plant.name, plant.n, energy)
+        return energy
+
+    def get_energies(self, plant, layouts, engine="batch", sun=None):
+        ''' Returns utils.get_energies of the layouts of the plant, only the
+        layouts not in the store are simulated, together in one batch. '''
+        keys = [self.get_key(plant, layout, sun=sun, engine=engine)
+                for layout in layouts]
+        energies = np.array([np.nan if energy is None else energy
+                             for energy in map(self.get, keys)])
+        missing = np.flatnonzero(np.isnan(energies))
+        if len(missing) > 0:
+            energies[missing] = utils.get_energies(plant,
+                [layouts[k] for k in missing], engine=engine, sun=sun)
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            for k in missing:
+                self.put(keys[k], plant.name, len(layouts[k]), energies[k])
+            connection.execute("COMMIT")
+        return energies
+
+    def evict(self, max_entries):
+        ''' Deletes the least recently accessed results above max_entries,
+        returns the number of deleted results. '''
+        self.flush()
+        cursor = self.connect().execute("""DELETE FROM results WHERE key IN (
+            SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)""",
+            (max_entries,))
+        return cursor.rowcount
+
+    def compact(self):
+        ''' Merges the write-ahead log into the database and rebuilds it to
+        release the space of deleted results. '''
+        connection = self.connect()
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("VACUUM")
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __str__(self):
+        connection = self.connect()
+        out = "ResultStore {}: {} results".format(self.file_name, len(self))
+        for plant, n, count, energy in connection.execute("""SELECT plant, n,
+                COUNT(*), MAX(energy) FROM results GROUP BY plant, n"""):
+            out += "\n\t- {}, n = {}: {} results, best energy {:.4f}".format(
+                plant, n, count, energy)
+        size = sum(os.path.getsize(self.file_name + suffix)
+                   for suffix in ["", "-wal"]
+                   if os.path.exists(self.file_name + suffix))
+        out += "\n\t- size: {:.1f} MB".format(size / 2**20)
+        if self.hits + self.misses > 0:
+            out += "\n\t- {} hits, {} misses".format(self.hits, self.misses)
+        return out
+
+if __name__ == "__main__":
+    store = ResultStore()
+    command = sys.argv[1] if len(sys.argv) > 1 else "info"
+    if command == "evict":
+        print("deleted {} results".format(store.evict(int(sys.argv[2]))))
+    elif command == "compact":
+        store.compact()
+    print(store)
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+""" sun-quadrature.py - accuracy of the weighted sun models against the
+    energy with Sun(180) for the layouts in ../data/layouts.
+
+    Usage:
+        sun-quadrature.py [engine] """
+
+import sys
+import glob
+import os
+from plant import Plant
+from sun import Sun
+import utils
+
+if __name__ == "__main__":
+    engine = sys.argv[1] if len(sys.argv) > 1 else "batch"
+    suns = [("lobatto 9", Sun(9, quadrature="lobatto")),
+            ("lobatto 17", Sun(17, quadrature="lobatto")),
+            ("lobatto 33", Sun(33, quadrature="lobatto"))]
+    tols = [1e-2, 1e-3]
+
+    print("relative errors against Sun(180), engine = " + engine)
+    print("adaptive: m / error / error estimate\n")
+    out = "{:24s} {:>9s}".format("layout", "energy")
+    for name, sun in suns:
+        out += " {:>10s}".format(name)
+    for tol in tols:
+        out += " {:>24s}".format("adaptive {:.0e}".format(tol))
+    print(out)
+
+    for file_name in sorted(glob.glob("../data/layouts/*.json")):
+        plant = Plant(utils.load(file_name))
+        reference = utils.get_energy(plant, engine=engine)
+        out = "{:24s} {:9.2f}".format(os.path.basename(file_name), reference)
+        for name, sun in suns:
+            energy = utils.get_energy(plant, engine=engine, sun=sun)
+            out += " {:10.1e}".format(abs(energy - reference) / reference)
+        for tol in tols:
+            sun = utils.get_adaptive_sun(plant, tol=tol, engine=engine)
+            energy = utils.get_energy(plant, engine=engine, sun=sun)
+            out += " {:>24s}".format("{:d} / {:.1e} / {:.1e}".format(
+                sun.m, abs(energy - reference) / reference, sun.error))
+        print(out)
@@ -2,21 +2,45 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from numpy.polynomial import legendre
 
 class Sun:
     ''' Models the sun positions, parameters are m = number of time steps,
     and times of sunrise and sunset. For example m = 17 hours from sunrise
     at 5:00 to sunset at 21:00.
+
+    The energy is the weighted sum of the powers in the sun positions, with
+    weights of ones for m equally spaced positions. With quadrature="lobatto"
+    the m positions and weights are of Gauss-Lobatto quadrature, scaled so
+    that the energy estimates the energy of ref_m equally spaced positions,
+    see also utils.get_adaptive_sun.
     '''
-    def __init__(self, m=17, sunrise=5, sunset=21):
-        self.m = m
-        self.angles = np.linspace(0, np.pi, self.m)
+    def __init__(self, m=17, sunrise=5, sunset=21, quadrature=None, ref_m=180):
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.error = None # error estimate of the energy, if known
+        if quadrature is None:
+            self.set_angles(np.linspace(0, np.pi, m), np.ones(m))
+            self.times = [str(int(time))+":00" for\
+                time in list(np.linspace(sunrise, sunset, self.m))]
+        elif quadrature == "lobatto":
+            xs, ws = get_lobatto(m)
+            weights = (ref_m - 1) / 2 * ws
+            weights[[0, -1]] += 0.5
+            self.set_angles((xs + 1) * np.pi / 2, weights)
+        else:
+            raise ValueError("unknown quadrature: " + str(quadrature))
+
+    def set_angles(self, angles, weights):
+        ''' Sets the sun positions and their weights. '''
+        self.m = len(angles)
+        self.angles = np.array(angles)
+        self.weights = np.array(weights, dtype=float)
         self.angles_deg = np.degrees(self.angles)
         self.ts = list(range(self.m))
-        self.times = [str(int(time))+":00" for\
-            time in list(np.linspace(sunrise, sunset, self.m))]
+        hours = self.sunrise + self.angles / np.pi * (self.sunset - self.sunrise)
+        self.times = ["{:d}:{:02d}".format(int(hour), int(60 * (hour % 1)))
+                      for hour in hours]
 
     def __str__(self):
         out = "Sun: "
@@ -26,6 +50,8 @@ class Sun:
         return out
 
     def draw(self, name=None):
+        ## matplotlib is imported only for drawing
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         plt.axis('equal')
 
@@ -44,3 +70,14 @@ class Sun:
                 facecolor=fig.get_facecolor(), edgecolor='none', dpi=100)
         else:
             plt.show()
+
+def get_lobatto(m):
+    ''' Returns the m nodes and weights of Gauss-Lobatto quadrature on
+    [-1, 1], the nodes include the end points, so m >= 2. '''
+    if m < 2:
+        raise ValueError("Gauss-Lobatto quadrature needs m >= 2 nodes, not " + str(m))
+    legendre_m = np.zeros(m)
+    legendre_m[-1] = 1
+    xs = np.concatenate(([-1], legendre.legroots(legendre.legder(legendre_m)), [1]))
+    ws = 2 / (m * (m - 1) * legendre.legval(xs, legendre_m)**2)
+    return xs, ws
@@ -1,14 +1,16 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
 import json
 import numpy as np
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 from sun import Sun
+import profiling
+import records
 from state import State
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+import batch
 
 def save(d, file_name, indent=0):
     ''' Saves the layout, or plant specs in dictionary format to JSON file. '''
@@ -28,51 +30,292 @@ def save_layout(xs, ys, layout_name, indent=4):
     with open(file_name, 'w') as file:
         json.dump(d, file, indent=indent)
 
-def get_energy(plant, do_stats=False):
-    ''' Returns the energy for a given plant initialized with a layout. '''
+def grid_layout(plant, n, jitter=0.0, seed=None):
+    ''' Returns a layout of n heliostats placed on a regular grid over the
+    plants field area, used for benchmarks and tests on larger fields.
+    Points can be randomly displaced by up to jitter * grid spacing. '''
+    width = plant.x_max - plant.x_min
+    height = plant.y_max - plant.y_min
+    nx = max(1, int(np.ceil(np.sqrt(n * width / height))))
+    ny = max(1, int(np.ceil(n / nx)))
+    xs = np.linspace(plant.x_min, plant.x_max, nx + 2)[1:-1]
+    ys = np.linspace(plant.y_min, plant.y_max, ny + 2)[1:-1]
+    layout = np.array([[x, y] for y in ys for x in xs])[:n]
+    if jitter > 0:
+        rng = np.random.default_rng(seed)
+        step = np.array([width / (nx + 1), height / (ny + 1)])
+        layout = layout + rng.uniform(-jitter, jitter, layout.shape) * step
+    return layout
+
+def get_energy(plant, do_stats=False, engine="batch", verbose=True, sun=None,
+               out=None):
+    ''' Returns the energy for a given plant initialized with a layout.
+    The engine is one of:
+        * "batch": all sun angles are evaluated at once, see batch.get_powers
+        * "state": a State is constructed for each sun angle
+        * "grid": as "state" using a spatial index, for large fields
+        * "interval": as "batch" with exact shaded, blocked and missed parts
+        of the heliostats instead of the rays, see batch.get_fractions
+    If do_stats, it also returns the stats and prints them if verbose.
+    The sun model defaults to Sun(180), the energy is the sum of the powers
+    weighted by sun.weights. With out, a mapping of records.COLUMNS to
+    arrays of shape (sun.m,) such as a row of records.StatsBuffer, the stats
+    are written to out without building DataFrames, along with the energy
+    if out has an "energy" array of shape (1,), and only the energy is
+    returned.
+    '''
     ## sun model: Sun(the number of angles / sun directions we consider)
-    sun = Sun(180)
-    powers = np.zeros(sun.m)
-    if do_stats:
-        etas_means_m = np.zeros((sun.m, 3))
-        sbms_props_m = np.zeros((sun.m, 3))
-
-    for t in sun.ts:
-        sun_angle = sun.angles[t]
-        state = State(plant, sun_angle)
-        power, etas_means, sbms_props = get_power(plant, state)
-        powers[t] = power
-        if do_stats:
-            etas_means_m[t] = etas_means
-            sbms_props_m[t] = sbms_props
+    if sun is None:
+        sun = Sun(180)
+    if do_stats and out is None:
+        out = records.get_row(sun.m)
+    with profiling.phase("energy"):
+        if engine in ["batch", "interval"]:
+            powers = batch.get_powers(plant, sun.angles, do_stats=False,
+                exact=(engine == "interval"), out=out)[0]
+        else:
+            powers = np.zeros(sun.m) if out is None else out["power"]
+            for t in sun.ts:
+                sun_angle = sun.angles[t]
+                state = State(plant, sun_angle, grid=(engine == "grid"))
+                power, etas_means, sbms_props = get_power(plant, state,
+                                                          out is not None)
+                powers[t] = power
+                if out is not None:
+                    records.write_stats(out, t, power, etas_means, sbms_props)
 
-    if do_stats:
-        powers_df = pd.DataFrame({'time': sun.times, 'power': powers})
-        etas_means_df = pd.DataFrame(etas_means_m, columns=["mu_aa", "mu_cos", "mu_sbm"])
-        sbms_props_df = pd.DataFrame(sbms_props_m, columns=["pi_sha", "pi_blo", "pi_mis"])
-        stats_df = pd.concat([powers_df, etas_means_df, sbms_props_df], axis=1)
-        etas_means_means = list(np.apply_along_axis(np.mean, 0, etas_means_m))
-        sbms_props_means = list(np.apply_along_axis(np.mean, 0, sbms_props_m))
+        if do_stats:
+            ## pandas is imported only for the stats
+            import pandas as pd
+            with profiling.phase("stats"):
+                stats_df = pd.DataFrame({"time": sun.times, **{column: out[column]
+                                         for column in records.COLUMNS}})
+                etas_means_means = [np.mean(out[column])
+                                    for column in records.ETA_COLUMNS]
+                sbms_props_means = [np.mean(out[column])
+                                    for column in records.SBM_COLUMNS]
 
-    energy = np.sum(powers)
+        energy = np.sum(sun.weights * powers)
+        if out is not None and "energy" in out:
+            out["energy"][0] = energy
 
-    if do_stats:
-        out = ""
-        out += "\n\t- energy = {:4.20f}\n".format(energy)
-        out += "\n\t         {:6s}  {:6s}  {:6s}".format("mu_aa", "mu_cos", "mu_sbm")
-        out += "\n\t- etas:  {:.4f}, {:.4f}, {:.4f}\n"\
+    if do_stats and verbose:
+        report = ""
+        report += "\n\t- energy = {:4.20f}\n".format(energy)
+        report += "\n\t         {:6s}  {:6s}  {:6s}".format("mu_aa", "mu_cos", "mu_sbm")
+        report += "\n\t- etas:  {:.4f}, {:.4f}, {:.4f}\n"\
             .format(etas_means_means[0], etas_means_means[1], etas_means_means[2])
-        out += "\n\t         {:6s}  {:6s}  {:6s}".format("pi_sha", "pi_blo", "pi_mis")
-        out += "\n\t- sbms:  {:.4f}, {:.4f}, {:.4f}\n"\
+        report += "\n\t         {:6s}  {:6s}  {:6s}".format("pi_sha", "pi_blo", "pi_mis")
+        report += "\n\t- sbms:  {:.4f}, {:.4f}, {:.4f}\n"\
             .format(sbms_props_means[0], sbms_props_means[1], sbms_props_means[2])
-        print(out)
+        print(report)
 
     if do_stats:
         return energy, stats_df, powers
     else:
         return energy
 
+def get_energies(plant, layouts, engine="batch", sun=None):
+    ''' Returns the energies of many layouts of the plant as an array, the
+    same as get_energy for each layout, evaluated together in one batch,
+    see batch.get_energies. The engine is "batch" or "interval". The plant
+    itself is not changed. '''
+    if sun is None:
+        sun = Sun(180)
+    return batch.get_energies(plant, layouts, sun.angles,
+                              exact=(engine == "interval"), weights=sun.weights)
+
+def get_powers(plant, sun_angles, engine="batch"):
+    ''' Returns the powers in the sun angles as in get_energy. '''
+    if engine in ["batch", "interval"]:
+        return batch.get_powers(plant, sun_angles, do_stats=False,
+                                exact=(engine == "interval"))[0]
+    return np.array([get_power(plant, State(plant, sun_angle,
+        grid=(engine == "grid")), do_stats=False)[0] for sun_angle in sun_angles])
+
+def get_adaptive_sun(plant, tol=1e-3, engine="batch", m0=9, ref_m=180):
+    ''' Returns a Sun with the positions and weights of adaptive Simpson
+    quadrature of the power over the sun angle, so that the energy estimates
+    the energy with Sun(ref_m) to relative tolerance tol.
+
+    Starting from m0 equally spaced positions, the panels with the largest
+    differences between Simpson and trapezoidal rules are halved until the
+    sum of the differences, the error estimate in sun.error, is below
+    tol * energy, or the panels are as short as the spacing of Sun(ref_m).
+    The new positions of each step are evaluated together. The energy of
+    the plant is np.sum(sun.weights * powers), and the same sun can be
+    used with get_energy for other layouts close to the layout of plant.
+    '''
+    ## energy of Sun(ref_m) is the trapezoidal rule times scale, plus half
+    ## of the powers at sunrise and sunset
+    scale = (ref_m - 1) / np.pi
+    min_width = 2 * np.pi / (ref_m - 1)
+
+    ## panels [a, b] with the midpoint, the powers of all the positions
+    angles = np.linspace(0, np.pi, 2 * m0 - 1)
+    powers = dict(zip(angles, get_powers(plant, angles, engine)))
+    panels = list(zip(angles[:-1:2], angles[2::2]))
+    while True:
+        weights = dict.fromkeys(powers, 0.0)
+        weights[0.0] += 0.5
+        weights[np.pi] += 0.5
+        errors = np.zeros(len(panels))
+        for k, (a, b) in enumerate(panels):
+            mid = (a + b) / 2
+            weights[a] += scale * (b - a) / 6
+            weights[mid] += scale * 4 * (b - a) / 6
+            weights[b] += scale * (b - a) / 6
+            errors[k] = scale * (b - a) / 12 * \
+                abs(powers[a] - 2 * powers[mid] + powers[b])
+        energy = sum(weights[angle] * powers[angle] for angle in powers)
+        error = np.sum(errors)
+
+        refine = [k for k in range(len(panels)) if errors[k] > \
+            tol * energy / len(panels) and panels[k][1] - panels[k][0] > min_width]
+        if error <= tol * energy or not refine:
+            break
+
+        ## halve the panels, their midpoints become the end points
+        new_panels, new_angles = [], []
+        for k, (a, b) in enumerate(panels):
+            if k in refine:
+                mid = (a + b) / 2
+                new_panels += [(a, mid), (mid, b)]
+                new_angles += [(a + mid) / 2, (mid + b) / 2]
+            else:
+                new_panels.append((a, b))
+        new_angles = np.array(new_angles)
+        powers.update(zip(new_angles, get_powers(plant, new_angles, engine)))
+        panels = new_panels
+
+    sun = Sun(ref_m)
+    order = sorted(powers)
+    sun.set_angles(order, [weights[angle] for angle in order])
+    sun.error = error / energy
+    return sun
+
+def get_gradient(plant, h=1e-3, engine="interval", sun=None):
+    ''' Returns the gradient of the energy with respect to the heliostats
+    coordinates of shape (n, 2), estimated by central differences with
+    step h. The energy of the "batch" engine is piecewise constant in the
+    layout, so the default is the continuous "interval" engine. Each of
+    the 4n perturbed layouts moves one heliostat, so with the "interval"
+    engine only the intervals of the moved heliostat are computed for each
+    layout, see batch.get_moved_energies. '''
+    if sun is None:
+        sun = Sun(180)
+    layout = np.array(plant.layout, dtype=float)
+    if engine == "interval":
+        moves = np.tile(np.repeat(np.arange(plant.n), 2), 2)
+        steps = h * np.tile(np.eye(2), (plant.n, 1))
+        positions = np.concatenate((layout[moves[:2 * plant.n]] + steps,
+                                    layout[moves[:2 * plant.n]] - steps))
+        energies = batch.get_moved_energies(plant, moves, positions, sun.angles,
+                                            weights=sun.weights)
+    else:
+        steps = h * np.eye(2 * plant.n).reshape((2 * plant.n, plant.n, 2))
+        layouts = np.concatenate((layout + steps, layout - steps))
+        energies = get_energies(plant, layouts, engine=engine, sun=sun)
+    gradient = (energies[:2 * plant.n] - energies[2 * plant.n:]) / (2 * h)
+    return gradient.reshape((plant.n, 2))
+
+## plant and result store of the worker process, see evaluate_many
+worker_plant = None
+worker_store = None
+
+def init_worker(plant_d, store=None):
+    ''' Constructs the plant once in each worker process. '''
+    from plant import Plant
+    global worker_plant, worker_store
+    worker_plant = Plant(plant_d=plant_d)
+    worker_store = store
+
+def evaluate_chunk(chunk, skip_invalid=False, do_stats=False, engine="batch"):
+    ''' Evaluates a chunk of (index, layout) pairs on the worker plant and
+    returns a list of (index, energy, valid, stats_df) tuples. With
+    do_stats="columnar" the stats are arrays of shape (len(records.COLUMNS),
+    m) instead of DataFrames. '''
+    results = []
+    for index, layout in chunk:
+        worker_plant.layout = np.array(layout)
+        worker_plant.set_layout()
+        valid = worker_plant.valid_layout
+        energy, stats_df = np.nan, None
+        if valid or not skip_invalid:
+            ## look up the result store first, see store.ResultStore
+            evaluate = get_energy if worker_store is None else worker_store.get_energy
+            if do_stats == "columnar" and worker_store is None:
+                stats_df = np.empty((len(records.COLUMNS), Sun(180).m))
+                energy = get_energy(worker_plant, engine=engine,
+                    out=dict(zip(records.COLUMNS, stats_df)))
+            elif do_stats:
+                energy, stats_df, _ = evaluate(worker_plant, do_stats=True,
+                                               engine=engine, verbose=False)
+                if do_stats == "columnar":
+                    stats_df = stats_df[records.COLUMNS].to_numpy().T
+            else:
+                energy = evaluate(worker_plant, engine=engine)
+        results.append((index, energy, valid, stats_df))
+    if worker_store is not None:
+        worker_store.flush()
+    return results
+
+def evaluate_many(layouts, plant_d, workers=None, chunksize=None,
+                  skip_invalid=False, stats=None, engine="batch", store=None):
+    ''' Evaluates many layouts in parallel using a pool of worker processes.
+    Inputs:
+        * layouts: list of layouts, each a list of coordinates
+        * plant_d: plant specs as a dictionary, sent to each worker once
+        * workers: number of processes, defaults to the number of cores,
+        with workers=1 the layouts are evaluated in this process
+        * chunksize: number of layouts sent to a worker at once
+        * skip_invalid: if True, the energy of invalid layouts is not
+        computed and it is set to nan
+        * stats: optional collector called as stats(index, stats_df) for each
+        evaluated layout, in input order, see get_energy(do_stats=True), or a
+        records.StatsBuffer that gets the energies and the stats of the
+        layouts in its rows of the same indices, without DataFrames
+        * store: optional store.ResultStore, the layouts in the store are not
+        simulated again and the new results are added to it
+    Returns the energies and validity flags as arrays in input order.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    n_layouts = len(layouts)
+    if chunksize is None:
+        chunksize = max(1, int(np.ceil(n_layouts / (4 * workers))))
+    chunks = [list(zip(range(i, min(n_layouts, i + chunksize)),
+                       layouts[i:i + chunksize]))
+              for i in range(0, n_layouts, chunksize)]
+    columnar = isinstance(stats, records.StatsBuffer)
+    options = {"skip_invalid": skip_invalid,
+               "do_stats": "columnar" if columnar else stats is not None,
+               "engine": engine}
+
+    if workers == 1:
+        init_worker(plant_d, store)
+        results = [evaluate_chunk(chunk, **options) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(plant_d, store)) as executor:
+            futures = [executor.submit(evaluate_chunk, chunk, **options)
+                       for chunk in chunks]
+            results = [future.result() for future in futures]
+
+    energies = np.full(n_layouts, np.nan)
+    valid = np.zeros(n_layouts, dtype=bool)
+    for chunk_results in results:
+        for index, energy, valid_layout, stats_df in chunk_results:
+            energies[index] = energy
+            valid[index] = valid_layout
+            if columnar and stats_df is not None:
+                stats.put(index, energy, stats_df)
+            elif stats is not None and stats_df is not None:
+                stats(index, stats_df)
+    return energies, valid
+
 def draw(plant, powers):
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     sun = Sun()
     ax.plot(sun.times, powers)
@@ -87,23 +330,24 @@ def get_power(plant, state, do_stats=True):
         * etas_means = [mean_aa, mean_cos, mean_sbm]
         * sbms_props = [prop_sh, prop_blo, prop_mis]
     '''
-    power = 0.0
-    if do_stats:
-        etas = np.zeros((plant.n, 3))
-        sbms = np.zeros((plant.n, 3))
-
-    for i in range(plant.n):
-        eta_aa, eta_cos, eta_sbm, not_sbm = state.get_effects(i, verbose=False)
-        power += eta_aa * eta_cos * eta_sbm
+    with profiling.phase("power"):
+        power = 0.0
         if do_stats:
-            etas[i] = eta_aa, eta_cos, eta_sbm
-            sbms[i] = plant.heli_rays - not_sbm
+            etas = np.zeros((plant.n, 3))
+            sbms = np.zeros((plant.n, 3))
 
-    if do_stats:
-        n_all_rays = plant.n * plant.heli_rays
-        etas_means = np.apply_along_axis(np.mean, 0, etas)
-        sbms_props = np.apply_along_axis(np.sum, 0, sbms) / n_all_rays
-    else:
-        etas_means, sbms_props = None, None
+        for i in range(plant.n):
+            eta_aa, eta_cos, eta_sbm, not_sbm = state.get_effects(i, verbose=False)
+            power += eta_aa * eta_cos * eta_sbm
+            if do_stats:
+                etas[i] = eta_aa, eta_cos, eta_sbm
+                sbms[i] = plant.heli_rays - not_sbm
+
+        if do_stats:
+            n_all_rays = plant.n * plant.heli_rays
+            etas_means = np.mean(etas, axis=0)
+            sbms_props = np.sum(sbms, axis=0) / n_all_rays
+        else:
+            etas_means, sbms_props = None, None
 
-    return power, etas_means, sbms_props
+        return power, etas_means, sbms_props